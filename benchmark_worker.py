@@ -0,0 +1,79 @@
+"""Benchmark the overhead of the redis worker with a fake classifier.
+
+Requires a running redis server (see REDIS_HOST in the settings). Example:
+
+> python benchmark_worker.py --n-jobs 2000 --batch-size 16
+"""
+import argparse
+import os
+import time
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "predict_api.settings")
+django.setup()
+
+from django.conf import settings  # noqa: E402
+from predict.messages import encode  # noqa: E402
+from tensorflow_worker.workers import RedisWorker  # noqa: E402
+
+QUEUE = "benchmark_queue"
+TEXT = "Exérèse de lésion superficielle"
+
+
+def fake_predict(texts):
+    return [{"labels": ["XXXX001"]} for _ in texts]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n-jobs", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--timeout", type=int, default=None)
+    parser.add_argument("--format", choices=["json", "msgpack"], default="json")
+    parser.add_argument(
+        "--text-length", type=int, default=None, help="length of the texts in characters"
+    )
+    parser.add_argument(
+        "--chunk-size", type=int, default=1, help="number of jobs per queue message"
+    )
+    args = parser.parse_args()
+
+    # format of the results sent by the worker
+    settings.REDIS_MESSAGE_FORMAT = args.format
+    worker = RedisWorker(
+        max_batch_size=args.batch_size, queue=QUEUE, timeout=args.timeout
+    )
+    db = worker.db
+    db.delete(QUEUE)
+
+    text = TEXT
+    if args.text_length:
+        text = (TEXT + " ") * (args.text_length // (len(TEXT) + 1) + 1)
+    # distinct texts, the identical documents of a batch are predicted once
+    jobs = [
+        {"id": "benchmark-{}".format(i), "text": "{} {}".format(i, text)}
+        for i in range(args.n_jobs)
+    ]
+    messages = [
+        encode({"jobs": jobs[i : i + args.chunk_size]}, args.format)
+        for i in range(0, len(jobs), args.chunk_size)
+    ]
+    db.rpush(QUEUE, *messages)
+
+    start = time.time()
+    n_batches = 0
+    while db.llen(QUEUE) or worker.buffer:
+        worker.run_loop_once(fake_predict)
+        n_batches += 1
+    elapsed = time.time() - start
+
+    db.delete(*["benchmark-{}".format(i) for i in range(args.n_jobs)])
+
+    print("{} jobs in {} batches".format(args.n_jobs, n_batches))
+    print("{:.3f} milliseconds per batch".format(elapsed / n_batches * 1000))
+    print("{:.1f} jobs per second".format(args.n_jobs / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import math
+import time
+
+from django.conf import settings
+
+# Admit ARGV[2] messages (ARGV[5] documents) to the queue KEYS[1]. They are
+# rejected if the queue would hold more than ARGV[1] messages (returns "depth"
+# and the number of excess messages) or if the token bucket KEYS[2] of the user
+# (rate ARGV[3] documents per second, burst ARGV[4]) does not hold enough tokens
+# at the time ARGV[6] (returns "rate" and the time to wait in ms). Returns an
+# empty list if the jobs are admitted, a limit of 0 disables the check.
+ADMISSION_SCRIPT = """
+local max_depth = tonumber(ARGV[1])
+if max_depth > 0 then
+    local excess = redis.call('LLEN', KEYS[1]) + tonumber(ARGV[2]) - max_depth
+    if excess > 0 then
+        return {'depth', excess}
+    end
+end
+local rate = tonumber(ARGV[3])
+if rate > 0 then
+    local burst, cost, now = tonumber(ARGV[4]), tonumber(ARGV[5]), tonumber(ARGV[6])
+    local bucket = redis.call('HMGET', KEYS[2], 'tokens', 'time')
+    local tokens = tonumber(bucket[1]) or burst
+    local last = tonumber(bucket[2]) or now
+    tokens = math.min(burst, tokens + math.max(now - last, 0) * rate)
+    -- the requests larger than the burst are admitted with a full bucket and
+    -- leave a debt
+    local needed = math.min(cost, burst)
+    if tokens < needed then
+        return {'rate', math.ceil((needed - tokens) / rate * 1000)}
+    end
+    tokens = tokens - cost
+    redis.call('HMSET', KEYS[2], 'tokens', tostring(tokens), 'time', ARGV[6])
+    redis.call('EXPIRE', KEYS[2], math.ceil((burst - tokens) / rate) + 1)
+end
+return {}
+"""
+
+
+class AdmissionControl:
+    """Admission control of the prediction jobs.
+
+    The jobs are rejected when the queue holds more than PREDICT_MAX_QUEUE_DEPTH
+    messages (PREDICT_MAX_QUEUE_DEPTHS per queue or lane) or when the user sends
+    more than PREDICT_RATE_LIMIT documents per second, with bursts of at most
+    PREDICT_RATE_BURST documents. Both checks are done atomically in redis."""
+
+    def __init__(self, db):
+        "db: redis connection"
+
+        self.db = db
+        self._admission_script = db.register_script(ADMISSION_SCRIPT)
+
+    def admit(self, queue, lane, tenant, messages, documents):
+        """Check if the messages of a user can be pushed to a lane of the queue.
+
+        Returns None if they are admitted, else the reason ("depth" or "rate")
+        and the number of seconds after which the request should be retried."""
+
+        max_depth = settings.PREDICT_MAX_QUEUE_DEPTHS.get(
+            lane, settings.PREDICT_MAX_QUEUE_DEPTH
+        )
+        rejection = self._admission_script(
+            keys=[lane, settings.REDIS_RATE_LIMIT_PREFIX + str(tenant)],
+            args=[
+                max_depth,
+                messages,
+                settings.PREDICT_RATE_LIMIT,
+                settings.PREDICT_RATE_BURST,
+                documents,
+                time.time(),
+            ],
+        )
+        if not rejection:
+            return None
+        reason, value = rejection
+        reason = reason.decode()
+        if reason == "rate":
+            return reason, max(math.ceil(value / 1000), 1)
+
+        # time for the workers to pop the excess messages
+        throughput = self.throughput(queue)
+        if not throughput:
+            return reason, settings.PREDICT_RETRY_AFTER
+        return reason, max(math.ceil(value / throughput), 1)
+
+    def throughput(self, queue):
+        """Return the number of messages popped per second by the live workers
+        of the queue (None if unknown)."""
+
+        workers = self.db.zrangebyscore(
+            settings.WORKER_HEARTBEAT_PREFIX + queue,
+            time.time() - settings.WORKER_HEARTBEAT_TTL,
+            "+inf",
+        )
+        if not workers:
+            return None
+        rates = self.db.hmget(settings.WORKER_THROUGHPUT_PREFIX + queue, workers)
+        rates = [float(rate) for rate in rates if rate is not None]
+        return sum(rates) or None
@@ -0,0 +1,224 @@
+import hashlib
+import json
+import re
+import time
+
+from django.conf import settings
+
+# Trim the index (sorted set by insertion time) KEYS[1] of the cached results to
+# ARGV[1] entries, deleting the oldest results.
+TRIM_CACHE_SCRIPT = """
+local excess = redis.call('ZCARD', KEYS[1]) - tonumber(ARGV[1])
+if excess <= 0 then
+    return 0
+end
+local keys = redis.call('ZRANGE', KEYS[1], 0, excess - 1)
+redis.call('ZREMRANGEBYRANK', KEYS[1], 0, excess - 1)
+for i = 1, #keys, 1000 do
+    redis.call('DEL', unpack(keys, i, math.min(i + 999, #keys)))
+end
+return excess
+"""
+
+# Register the documents of a request as in flight. For each pair of keys (in
+# flight key, waiters list), the document becomes the leader (returns 1) if it is
+# not in flight yet, joins the waiters of the leader (returns 0) if the leader
+# has a later deadline (ARGV[1]), or is processed independently (returns -1).
+# ARGV[2] and ARGV[3] are the expiry of the in flight key and of the waiters in
+# ms and ARGV[4..] the waiters. The waiters left by a lost leader are adopted by
+# the next leader whose waiters expire later.
+REGISTER_INFLIGHT_SCRIPT = """
+local deadline = tonumber(ARGV[1])
+local statuses = {}
+for i = 1, #KEYS / 2 do
+    local key, waiters = KEYS[2 * i - 1], KEYS[2 * i]
+    local leader_deadline = redis.call('GET', key)
+    if not leader_deadline then
+        if redis.call('PTTL', waiters) > tonumber(ARGV[3]) then
+            statuses[i] = -1
+        else
+            redis.call('SET', key, ARGV[1], 'PX', ARGV[2])
+            statuses[i] = 1
+        end
+    elseif tonumber(leader_deadline) >= deadline then
+        redis.call('RPUSH', waiters, ARGV[3 + i])
+        local ttl = math.max(
+            redis.call('PTTL', waiters), redis.call('PTTL', key), tonumber(ARGV[3])
+        )
+        redis.call('PEXPIRE', waiters, ttl)
+        statuses[i] = 0
+    else
+        statuses[i] = -1
+    end
+end
+return statuses
+"""
+
+# Atomically remove the documents (pairs of in flight key and waiters list) from
+# the in flight documents and return their waiters.
+CLAIM_INFLIGHT_SCRIPT = """
+local waiters = {}
+for i = 1, #KEYS / 2 do
+    waiters[i] = redis.call('LRANGE', KEYS[2 * i], 0, -1)
+    redis.call('DEL', KEYS[2 * i - 1], KEYS[2 * i])
+end
+return waiters
+"""
+
+# deadline of the asynchronous jobs, which do not expire
+NO_DEADLINE = 1e18
+
+
+def normalize_text(text):
+    "Collapse the whitespace of text, which does not change the predictions."
+
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class ResultCache:
+    """Cache of the prediction results of a queue in redis.
+
+    The results are keyed by the hash of the model version, the text and the
+    service hint. The workers publish the version of their model, so that the
+    results of older models are not returned after a model update (they expire
+    after RESULT_CACHE_TTL seconds). At most RESULT_CACHE_MAX_ENTRIES results are
+    kept per queue."""
+
+    def __init__(self, db, queue):
+        "db: redis connection"
+
+        self.db = db
+        self.queue = queue
+        self.prefix = settings.RESULT_CACHE_PREFIX
+        self.version_key = self.prefix + "version:" + queue
+        self.index_key = self.prefix + "index:" + queue
+        self.enabled = settings.RESULT_CACHE_MAX_ENTRIES > 0
+        self._trim_script = db.register_script(TRIM_CACHE_SCRIPT)
+
+    def key(self, version, text, service=None):
+        "Return the cache key of a document."
+
+        data = json.dumps([version, service, normalize_text(text)])
+        digest = hashlib.sha1(data.encode()).hexdigest()
+        return "{}{}:{}".format(self.prefix, self.queue, digest)
+
+    def get_version(self):
+        "Return the model version published by the workers (None if unknown)."
+
+        version = self.db.get(self.version_key)
+        return version.decode() if version is not None else None
+
+    def publish_version(self, version, pipe=None):
+        "Publish the model version of the worker (optionally in a pipeline)."
+
+        (pipe or self.db).set(self.version_key, version)
+
+    def get_many(self, version, documents):
+        """Return the cached results of documents (None if missing).
+
+        documents: list of (text, service) tuples"""
+
+        if not self.enabled or not documents:
+            return [None] * len(documents)
+        keys = [self.key(version, text, service) for text, service in documents]
+        return [json.loads(v) if v is not None else None for v in self.db.mget(keys)]
+
+    def set_many(self, version, results):
+        """Store the results of documents.
+
+        results: list of (text, service, labels) tuples"""
+
+        if not self.enabled or not results:
+            return
+        now = time.time()
+        ttl = settings.RESULT_CACHE_TTL
+        pipe = self.db.pipeline(transaction=False)
+        for text, service, labels in results:
+            key = self.key(version, text, service)
+            pipe.set(key, json.dumps(labels), ex=ttl or None)
+            pipe.zadd(self.index_key, {key: now})
+        if ttl:
+            # forget the expired results
+            pipe.zremrangebyscore(self.index_key, "-inf", now - ttl)
+        pipe.execute()
+        self._trim_script(
+            keys=[self.index_key], args=[settings.RESULT_CACHE_MAX_ENTRIES]
+        )
+
+
+class InflightRegistry:
+    """Registry of the documents being predicted (single-flight).
+
+    The first request of a document sends the job (leader) and the identical
+    documents sent before it finishes register as waiters, so that the worker
+    sends the result of the leader to all of them."""
+
+    def __init__(self, db, queue):
+        "db: redis connection"
+
+        self.db = db
+        self.queue = queue
+        self._register_script = db.register_script(REGISTER_INFLIGHT_SCRIPT)
+        self._claim_script = db.register_script(CLAIM_INFLIGHT_SCRIPT)
+
+    def key(self, text, service=None):
+        "Return the in flight key of a document."
+
+        data = json.dumps([service, normalize_text(text)])
+        digest = hashlib.sha1(data.encode()).hexdigest()
+        return "{}{}:{}".format(settings.REDIS_INFLIGHT_PREFIX, self.queue, digest)
+
+    @staticmethod
+    def waiters_key(key):
+        return key + ":waiters"
+
+    def register(self, keys, waiters, deadline=None):
+        """Register documents as in flight.
+
+        keys: in flight keys of the documents
+        waiters: descriptions of the waiting jobs (JSON with the id and the
+            reply_to key or persist flag)
+        deadline: time after which the jobs are dropped (None for asynchronous
+            jobs, whose leaders hold a lease of INFLIGHT_LEASE seconds, see
+            renew)
+        Returns the status of each document: 1 for a leader, 0 for a waiter
+        and -1 for a document that must be processed independently."""
+
+        if not keys:
+            return []
+        if deadline is None:
+            deadline = NO_DEADLINE
+            ttl, waiters_ttl = settings.INFLIGHT_LEASE, settings.INFLIGHT_TTL
+        else:
+            ttl = waiters_ttl = max(deadline - time.time(), 0) + 1
+        script_keys = []
+        for key in keys:
+            script_keys += [key, self.waiters_key(key)]
+        return self._register_script(
+            keys=script_keys,
+            args=[repr(deadline), int(ttl * 1000), int(waiters_ttl * 1000)] + waiters,
+        )
+
+    def renew(self, keys, pipe=None):
+        """Renew the lease of asynchronous leaders (optionally in a pipeline).
+
+        The workers renew the leases of the jobs they hold, the lease of a lost
+        job expires and the next identical document sends a new job, whose
+        results are sent to the waiters of the lost job too."""
+
+        client = pipe or self.db
+        for key in keys:
+            client.pexpire(key, int(settings.INFLIGHT_LEASE * 1000))
+
+    def claim(self, keys):
+        """Remove the documents from the in flight documents.
+
+        Returns the list of waiters (decoded JSON) of each document."""
+
+        if not keys:
+            return []
+        script_keys = []
+        for key in keys:
+            script_keys += [key, self.waiters_key(key)]
+        waiters = self._claim_script(keys=script_keys)
+        return [[json.loads(waiter) for waiter in doc_waiters] for doc_waiters in waiters]
@@ -0,0 +1,51 @@
+import json
+import zlib
+
+import msgpack
+from django.conf import settings
+
+# Binary messages start with a byte that neither JSON nor msgpack maps use,
+# followed by the envelope version and flags.
+MAGIC = b"\xc1"
+ENVELOPE_VERSION = 1
+FLAG_ZLIB = 1
+
+
+def encode(data, message_format=None):
+    """Serialize a queue message or result.
+
+    message_format: "json" or "msgpack" (settings.REDIS_MESSAGE_FORMAT by
+        default), msgpack payloads longer than MESSAGE_COMPRESS_MIN_SIZE bytes
+        are compressed with zlib"""
+
+    message_format = message_format or settings.REDIS_MESSAGE_FORMAT
+    if message_format == "json":
+        return json.dumps(data)
+    if message_format != "msgpack":
+        raise ValueError("unknown message format: {}".format(message_format))
+
+    payload = msgpack.packb(data, use_bin_type=True)
+    flags = 0
+    if len(payload) > settings.MESSAGE_COMPRESS_MIN_SIZE:
+        payload = zlib.compress(payload)
+        flags |= FLAG_ZLIB
+    return MAGIC + bytes([ENVELOPE_VERSION, flags]) + payload
+
+
+def decode(message):
+    """Deserialize a message in any of the supported formats.
+
+    Raises ValueError if the message is badly formatted."""
+
+    if isinstance(message, bytes) and message.startswith(MAGIC):
+        if len(message) < 3 or message[1] != ENVELOPE_VERSION:
+            raise ValueError("unsupported message envelope")
+        payload = message[3:]
+        try:
+            if message[2] & FLAG_ZLIB:
+                payload = zlib.decompress(payload)
+            return msgpack.unpackb(payload, raw=False)
+        except (zlib.error, msgpack.UnpackException, ValueError) as exc:
+            raise ValueError("badly formatted message: {}".format(exc))
+
+    return json.loads(message)
@@ -0,0 +1,40 @@
+# pushed to the queue for each message pushed to the sub-queue of a tenant, it
+# can not be confused with a JSON or msgpack message
+DOORBELL = b"\x00"
+
+# Add the tenant ARGV[1] to the back of the ring KEYS[1] (after the last tenant)
+# unless it is already active.
+JOIN_RING_SCRIPT = """
+if redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    return 0
+end
+local last = redis.call('ZRANGE', KEYS[1], -1, -1, 'WITHSCORES')
+return redis.call('ZADD', KEYS[1], (tonumber(last[2]) or 0) + 1, ARGV[1])
+"""
+
+
+def bulk_queue(queue):
+    """Return the low-priority lane of a queue.
+
+    The asynchronous (bulk) jobs are sent to this lane, so that the workers
+    process the synchronous jobs of the queue first."""
+
+    return queue + ":bulk"
+
+
+def tenant_queue(queue, tenant):
+    """Return the sub-queue of the jobs of a tenant (API user) in a queue.
+
+    The workers pop the messages of the active tenants of a queue in turn, so
+    that a large request does not delay the requests of the other users."""
+
+    return "{}:tenant:{}".format(queue, tenant)
+
+
+def tenants_key(queue):
+    """Return the key of the ring of the active tenants of a queue.
+
+    The ring is a sorted set of the tenants with messages waiting, the
+    tenants join it at the back (see JOIN_RING_SCRIPT)."""
+
+    return queue + ":tenants"
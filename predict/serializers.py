@@ -1,9 +1,15 @@
+from django.conf import settings
 from rest_framework import serializers
 
 
 class ReportSerializer(serializers.Serializer):
     id = serializers.CharField(required=False)
     text = serializers.CharField(max_length=100000)
+    service = serializers.CharField(
+        max_length=20,
+        required=False,
+        help_text="service id, if known (skips the prediction of the service)",
+    )
 
 
 class RequestSerializer(serializers.Serializer):
@@ -61,3 +67,11 @@ class PredictQuerySerializer(serializers.Serializer):
         default=0,
         required=False,
     )
+    timeout = serializers.FloatField(
+        # the results of shorter timeouts would not be ready in time
+        min_value=1,
+        max_value=settings.PREDICT_MAX_TIMEOUT,
+        help_text="maximum time (in seconds) to wait for synchronous predictions",
+        default=settings.PREDICT_TIMEOUT,
+        required=False,
+    )
@@ -0,0 +1,96 @@
+import time
+from unittest import mock
+
+import redis
+from django.conf import settings
+from django.test import TestCase, override_settings, tag
+
+from predict.admission import AdmissionControl
+
+
+@tag("redis")
+@override_settings(
+    PREDICT_MAX_QUEUE_DEPTH=3,
+    PREDICT_MAX_QUEUE_DEPTHS={"test-queue:bulk": 0},
+    PREDICT_RATE_LIMIT=2,
+    PREDICT_RATE_BURST=10,
+)
+class TestAdmissionControl(TestCase):
+    """Test the admission control of the prediction jobs.
+
+    These tests need running redis server."""
+
+    QUEUE = "test-queue"
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+
+        cls.db = redis.Redis(settings.REDIS_HOST)
+
+    def setUp(self):
+        super().setUp()
+        self.db.flushdb()
+        self.admission = AdmissionControl(self.db)
+
+    def tearDown(self):
+        super().tearDown()
+        self.db.flushdb()
+
+    def test_queue_depth(self):
+        "Test rejecting the messages that do not fit in the queue."
+
+        self.db.rpush(self.QUEUE, "a", "b")
+        self.assertIsNone(self.admission.admit(self.QUEUE, self.QUEUE, 1, 1, 1))
+
+        # no workers, default delay
+        self.assertEqual(
+            self.admission.admit(self.QUEUE, self.QUEUE, 1, 2, 2),
+            ("depth", settings.PREDICT_RETRY_AFTER),
+        )
+
+        # the delay is estimated from the throughput of the workers
+        now = time.time()
+        self.db.zadd(
+            settings.WORKER_HEARTBEAT_PREFIX + self.QUEUE,
+            {"worker-1": now, "worker-2": now, "dead-worker": now - 1000},
+        )
+        self.db.hmset(
+            settings.WORKER_THROUGHPUT_PREFIX + self.QUEUE,
+            {"worker-1": 0.5, "worker-2": 0.25, "dead-worker": 100},
+        )
+        self.assertEqual(
+            self.admission.admit(self.QUEUE, self.QUEUE, 1, 3, 3), ("depth", 3)
+        )
+
+        # no limit for the bulk lane
+        self.db.rpush(self.QUEUE + ":bulk", *range(10))
+        self.assertIsNone(
+            self.admission.admit(self.QUEUE, self.QUEUE + ":bulk", 1, 1, 1)
+        )
+
+    def test_rate_limit(self):
+        "Test limiting the rate of the documents sent by each user."
+
+        with mock.patch("time.time", return_value=1000.0):
+            self.assertIsNone(self.admission.admit(self.QUEUE, self.QUEUE, 1, 1, 8))
+            # the bucket holds 2 documents
+            self.assertEqual(
+                self.admission.admit(self.QUEUE, self.QUEUE, 1, 1, 3), ("rate", 1)
+            )
+            # other users have their own bucket
+            self.assertIsNone(self.admission.admit(self.QUEUE, self.QUEUE, 2, 1, 3))
+
+        with mock.patch("time.time", return_value=1001.0):
+            self.assertIsNone(self.admission.admit(self.QUEUE, self.QUEUE, 1, 1, 3))
+
+        # the requests larger than the burst wait for a full bucket
+        with mock.patch("time.time", return_value=1002.0):
+            self.assertEqual(
+                self.admission.admit(self.QUEUE, self.QUEUE, 1, 1, 20), ("rate", 4)
+            )
+        with mock.patch("time.time", return_value=1006.0):
+            self.assertIsNone(self.admission.admit(self.QUEUE, self.QUEUE, 1, 1, 20))
+            self.assertEqual(
+                self.admission.admit(self.QUEUE, self.QUEUE, 1, 1, 1), ("rate", 6)
+            )
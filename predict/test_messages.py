@@ -0,0 +1,43 @@
+from django.test import TestCase, override_settings
+
+from predict.messages import MAGIC, decode, encode
+
+
+class TestMessages(TestCase):
+    """Test the serialization of the queue messages."""
+
+    def test_json(self):
+        "Test the default JSON format."
+
+        message = encode({"id": "1", "text": "Test"})
+        self.assertEqual(message, '{"id": "1", "text": "Test"}')
+        self.assertEqual(decode(message), {"id": "1", "text": "Test"})
+        self.assertEqual(decode(message.encode()), {"id": "1", "text": "Test"})
+
+    @override_settings(MESSAGE_COMPRESS_MIN_SIZE=100)
+    def test_msgpack(self):
+        "Test the binary format, compressed for long messages."
+
+        data = {"id": "1", "text": "Exérèse", "deadline": 1.5}
+        message = encode(data, "msgpack")
+        self.assertTrue(message.startswith(MAGIC))
+        self.assertEqual(message[2], 0)
+        self.assertEqual(decode(message), data)
+
+        data = {"id": "1", "text": "Exérèse " * 100}
+        message = encode(data, "msgpack")
+        self.assertEqual(message[2], 1)
+        self.assertLess(len(message), 100)
+        self.assertEqual(decode(message), data)
+
+        with override_settings(REDIS_MESSAGE_FORMAT="msgpack"):
+            self.assertEqual(encode(data), message)
+
+    def test_bad_messages(self):
+        "Test if badly formatted messages raise ValueError."
+
+        for message in [b"{", MAGIC + b"\x02\x00", MAGIC + b"\x01\x01xxx"]:
+            with self.assertRaises(ValueError):
+                decode(message)
+        with self.assertRaises(ValueError):
+            encode({}, "xml")
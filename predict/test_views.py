@@ -1,12 +1,49 @@
 from unittest import mock
 from django.test import TestCase
 from users.models import User
+from predict.messages import MAGIC, decode, encode
 from predict.models import Prediction
+from predict.queues import DOORBELL, bulk_queue, tenant_queue, tenants_key
 from rest_framework.authtoken.models import Token
 import json
 
 from django.conf import settings
 
+
+def pushed_jobs(rpush):
+    "Return the jobs pushed with the mocked rpush (unpacking the envelopes)."
+
+    _, *messages = rpush.call_args[0]
+    jobs = []
+    for message in messages:
+        data = decode(message)
+        shared = {k: v for k, v in data.items() if k != "jobs"}
+        jobs.extend({**job, **shared} for job in data.get("jobs", [data]))
+    return jobs
+
+
+def reply_with(rpush, *replies):
+    """Mock the worker replies to the jobs pushed with the mocked rpush.
+
+    Each reply is a list of labels for the consecutive pushed jobs."""
+
+    replies = list(replies)
+
+    def blpop(key, timeout=0):
+        jobs = pushed_jobs(rpush)
+        reply_key = jobs[0]["reply_to"]
+        offset = sum(len(r) for r in blpop.sent)
+        labels = replies.pop(0)
+        blpop.sent.append(labels)
+        results = [
+            {"id": job["id"], **label} for job, label in zip(jobs[offset:], labels)
+        ]
+        return reply_key.encode(), json.dumps(results).encode()
+
+    blpop.sent = []
+    return blpop
+
+
 # Create your tests here.
 class TestPredictAPI(TestCase):
     @classmethod
@@ -19,13 +56,31 @@ class TestPredictAPI(TestCase):
             is_superuser=True,
         )
 
+        cls.user = user
         token = Token.objects.create(user=user)
         cls.token = token.key
 
+    def setUp(self):
+        super().setUp()
+
+        # no result cache and no identical documents in flight by default (the
+        # scripts, e.g. joining the ring of the active tenants, are not run)
+        for method, func in [
+            ("get", lambda key: None),
+            ("evalsha", lambda sha, numkeys, *args: [-1] * (numkeys // 2)),
+        ]:
+            patcher = mock.patch("redis.Redis." + method, side_effect=func)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # the jobs are admitted
+        patcher = mock.patch("predict.views.AdmissionControl.admit", return_value=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     @mock.patch("redis.Redis.rpush")
-    @mock.patch("redis.Redis.mget")
-    def test_predict_post(self, mget, rpush):
-        mget.return_value = [b'{"labels":["XXXTEST"]}']
+    @mock.patch("redis.Redis.blpop")
+    def test_predict_post(self, blpop, rpush):
+        blpop.side_effect = reply_with(rpush, [{"labels": ["XXXTEST"]}])
 
         response = self.client.post(
             "/predict/ccam/",
@@ -45,15 +100,17 @@ class TestPredictAPI(TestCase):
         )
 
     @mock.patch("redis.Redis.rpush")
-    @mock.patch("redis.Redis.mget")
-    def test_waiting_for_prediction(self, mget, rpush):
-        """Test if server waits for the prediction without failure."""
+    @mock.patch("redis.Redis.blpop")
+    def test_waiting_for_prediction(self, blpop, rpush):
+        """Test if server waits for the predictions sent in several replies."""
 
-        mget.side_effect = [[None], [b'{"labels":["XXXTEST"]}']]
+        blpop.side_effect = reply_with(
+            rpush, [{"labels": ["XXXTEST"]}], [{"labels": ["YYYTEST"]}]
+        )
 
         response = self.client.post(
             "/predict/ccam/",
-            data=json.dumps({"inputs": [{"text": "Test"}]}),
+            data=json.dumps({"inputs": [{"text": "Test"}, {"text": "Test 2"}]}),
             content_type="application/json",
             HTTP_AUTHORIZATION="Token {}".format(self.token),
         )
@@ -63,16 +120,20 @@ class TestPredictAPI(TestCase):
             response.json(),
             {
                 "predictions": [
-                    {"id": mock.ANY, "ccam_codes": ["XXXTEST"], "status": "done"}
+                    {"id": mock.ANY, "ccam_codes": ["XXXTEST"], "status": "done"},
+                    {"id": mock.ANY, "ccam_codes": ["YYYTEST"], "status": "done"},
                 ]
             },
         )
+        self.assertEqual(blpop.call_count, 2)
 
+    @mock.patch("redis.Redis.evalsha")
     @mock.patch("redis.Redis.rpush")
-    @mock.patch("redis.Redis.mget")
-    def test_return_same_id(self, mget, rpush):
+    @mock.patch("redis.Redis.blpop")
+    def test_return_same_id(self, blpop, rpush, evalsha):
         """Test if the same id is returned as passed with the request."""
-        mget.return_value = [b'{"id":"my-custom-id", "labels":["XXXTEST"]}']
+        blpop.side_effect = reply_with(rpush, [{"labels": ["XXXTEST"]}])
+        evalsha.side_effect = lambda sha, numkeys, *args: [-1] * (numkeys // 2)
 
         response = self.client.post(
             "/predict/ccam/",
@@ -91,20 +152,39 @@ class TestPredictAPI(TestCase):
             },
         )
 
-        rpush.assert_called_once_with(
-            settings.REDIS_SURGERY_QUEUE,
-            json.dumps({"id": "my-custom-id", "text": "Test"}),
+        # the job waits in the sub-queue of the user
+        rpush.assert_any_call(settings.REDIS_SURGERY_QUEUE, DOORBELL)
+        # the user joins the ring of the active tenants
+        evalsha.assert_called_with(
+            mock.ANY, 1, tenants_key(settings.REDIS_SURGERY_QUEUE), self.user.pk
+        )
+        rpush.assert_called_with(
+            tenant_queue(settings.REDIS_SURGERY_QUEUE, self.user.pk), mock.ANY
         )
-        mget.assert_called_once_with(["my-custom-id"])
+        job = json.loads(rpush.call_args[0][1])
+        self.assertEqual(
+            job,
+            {
+                "id": "my-custom-id",
+                "text": "Test",
+                "reply_to": mock.ANY,
+                "deadline": mock.ANY,
+            },
+        )
+        self.assertTrue(job["reply_to"].startswith(settings.REDIS_REPLY_PREFIX))
+        blpop.assert_called_once_with(job["reply_to"], timeout=mock.ANY)
 
     @mock.patch("redis.Redis.rpush")
-    @mock.patch("redis.Redis.mget")
-    def test_predict_post_many_inputs(self, mget, rpush):
-        mget.return_value = [
-            b'{"labels": ["XXXTEST"]}',
-            b'{"labels": ["YYYTEST"]}',
-            b'{"labels": ["ZZZTEST"]}',
-        ]
+    @mock.patch("redis.Redis.blpop")
+    def test_predict_post_many_inputs(self, blpop, rpush):
+        blpop.side_effect = reply_with(
+            rpush,
+            [
+                {"labels": ["XXXTEST"]},
+                {"labels": ["YYYTEST"]},
+                {"labels": ["ZZZTEST"]},
+            ],
+        )
 
         response = self.client.post(
             "/predict/ccam/",
@@ -133,13 +213,50 @@ class TestPredictAPI(TestCase):
         )
 
     @mock.patch("redis.Redis.rpush")
-    @mock.patch("redis.Redis.mget")
-    def test_forward_classifier_errors_to_user(self, mget, rpush):
+    @mock.patch("redis.Redis.blpop")
+    def test_job_envelopes(self, blpop, rpush):
+        """Test sending the jobs of a request in chunks."""
+
+        blpop.side_effect = reply_with(
+            rpush, [{"labels": ["TEST{}".format(i)]} for i in range(5)]
+        )
+
+        inputs = [{"id": str(i), "text": "Test {}".format(i)} for i in range(5)]
+        with self.settings(PREDICT_CHUNK_SIZE=2):
+            response = self.client.post(
+                "/predict/ccam/",
+                data=json.dumps({"inputs": inputs}),
+                content_type="application/json",
+                HTTP_AUTHORIZATION="Token {}".format(self.token),
+            )
+
+        self.assertEqual(
+            [p["ccam_codes"] for p in response.json()["predictions"]],
+            [["TEST{}".format(i)] for i in range(5)],
+        )
+        _, *messages = rpush.call_args[0]
+        self.assertEqual(len(messages), 3)
+        envelope = json.loads(messages[0])
+        self.assertEqual(
+            envelope,
+            {
+                "jobs": [{"id": "0", "text": "Test 0"}, {"id": "1", "text": "Test 1"}],
+                "reply_to": mock.ANY,
+                "deadline": mock.ANY,
+            },
+        )
+        # the last chunk has a single job
+        self.assertEqual(json.loads(messages[2])["id"], "4")
+
+    @mock.patch("redis.Redis.rpush")
+    @mock.patch("redis.Redis.blpop")
+    def test_forward_classifier_errors_to_user(self, blpop, rpush):
         "test if errors returned by classifer are returned to user."
 
-        mget.return_value = [
-            b'{"labels": ["ERROR"], "error_message": "error occurred", "status": "error"}'
-        ]
+        blpop.side_effect = reply_with(
+            rpush,
+            [{"labels": ["ERROR"], "error_message": "error occurred", "status": "error"}],
+        )
 
         response = self.client.post(
             "/predict/ccam/",
@@ -163,11 +280,11 @@ class TestPredictAPI(TestCase):
         )
 
     @mock.patch("redis.Redis.rpush")
-    @mock.patch("redis.Redis.mget")
-    def test_predict_severity_post(self, mget, rpush):
+    @mock.patch("redis.Redis.blpop")
+    def test_predict_severity_post(self, blpop, rpush):
         """Test request for severity level."""
 
-        mget.return_value = [b'{"labels":["XXXTEST"]}']
+        blpop.side_effect = reply_with(rpush, [{"labels": ["XXXTEST"]}])
 
         response = self.client.post(
             "/predict/severity/",
@@ -186,14 +303,14 @@ class TestPredictAPI(TestCase):
             },
         )
 
-        rpush.assert_called_once_with(
-            settings.REDIS_SEVERITY_LEVEL_QUEUE, mock.ANY,
+        rpush.assert_called_with(
+            tenant_queue(settings.REDIS_SEVERITY_LEVEL_QUEUE, self.user.pk), mock.ANY,
         )
 
     @mock.patch("redis.Redis.rpush")
-    @mock.patch("redis.Redis.mget")
-    def test_predict_asynchronous(self, mget, rpush):
-        mget.return_value = [b'{"labels":["XXXTEST"]}']
+    @mock.patch("redis.Redis.blpop")
+    def test_predict_asynchronous(self, blpop, rpush):
+        blpop.side_effect = reply_with(rpush, [{"labels": ["XXXTEST"]}])
 
         # asynchronous mode
         response = self.client.post(
@@ -207,9 +324,10 @@ class TestPredictAPI(TestCase):
         self.assertEqual(
             response.json(), {"predictions": [{"id": "test", "status": "queued"}]},
         )
-        mget.assert_not_called()
+        blpop.assert_not_called()
+        # in the bulk lane
         rpush.assert_called_with(
-            settings.REDIS_SURGERY_QUEUE,
+            tenant_queue(bulk_queue(settings.REDIS_SURGERY_QUEUE), self.user.pk),
             json.dumps({"id": "test", "text": "Test", "persist": True}),
         )
         self.assertTrue(Prediction.objects.filter(id="test").exists())
@@ -234,9 +352,277 @@ class TestPredictAPI(TestCase):
                 ]
             },
         )
-        mget.assert_called_with(["test-2"])
+        blpop.assert_called_once_with(
+            json.loads(rpush.call_args[0][1])["reply_to"], timeout=mock.ANY
+        )
         self.assertFalse(Prediction.objects.filter(id="test-2").exists())
 
+    @mock.patch("redis.Redis.mget")
+    @mock.patch("redis.Redis.get")
+    @mock.patch("redis.Redis.rpush")
+    @mock.patch("redis.Redis.blpop")
+    def test_cached_results(self, blpop, rpush, get, mget):
+        """Test returning the cached results without sending the jobs to workers."""
+
+        blpop.side_effect = reply_with(rpush, [{"labels": ["YYYTEST"]}])
+        get.return_value = b"v1"
+        mget.return_value = [json.dumps({"labels": ["XXXTEST"]}).encode(), None]
+
+        response = self.client.post(
+            "/predict/ccam/",
+            data=json.dumps({"inputs": [{"text": "Test 1"}, {"text": "Test 2"}]}),
+            content_type="application/json",
+            HTTP_AUTHORIZATION="Token {}".format(self.token),
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json(),
+            {
+                "predictions": [
+                    {"id": mock.ANY, "ccam_codes": ["XXXTEST"], "status": "done"},
+                    {"id": mock.ANY, "ccam_codes": ["YYYTEST"], "status": "done"},
+                ]
+            },
+        )
+        get.assert_called_once_with(
+            settings.RESULT_CACHE_PREFIX + "version:" + settings.REDIS_SURGERY_QUEUE
+        )
+        rpush.assert_called_with(
+            tenant_queue(settings.REDIS_SURGERY_QUEUE, self.user.pk), mock.ANY
+        )
+        self.assertEqual(json.loads(rpush.call_args[0][1])["text"], "Test 2")
+
+        # all results in the cache
+        rpush.reset_mock()
+        blpop.reset_mock()
+        mget.return_value = [json.dumps({"labels": ["XXXTEST"]}).encode()]
+        response = self.client.post(
+            "/predict/ccam/?asynch=1",
+            data=json.dumps({"inputs": [{"id": "cached", "text": "Test 1"}]}),
+            content_type="application/json",
+            HTTP_AUTHORIZATION="Token {}".format(self.token),
+        )
+
+        self.assertEqual(
+            response.json(),
+            {
+                "predictions": [
+                    {"id": "cached", "ccam_codes": ["XXXTEST"], "status": "done"}
+                ]
+            },
+        )
+        rpush.assert_not_called()
+        blpop.assert_not_called()
+        instance = Prediction.objects.get(id="cached")
+        self.assertEqual(instance.status, "done")
+        self.assertEqual(instance.labels, ["XXXTEST"])
+
+    @mock.patch("redis.Redis.rpush")
+    @mock.patch("redis.Redis.blpop")
+    def test_msgpack_messages(self, blpop, rpush):
+        """Test sending the jobs in the binary format."""
+
+        def reply(key, timeout=0):
+            job = decode(rpush.call_args[0][1])
+            results = [{"id": job["id"], "labels": ["XXXTEST"], "status": "done"}]
+            return job["reply_to"].encode(), encode(results, "msgpack")
+
+        blpop.side_effect = reply
+
+        with self.settings(REDIS_MESSAGE_FORMAT="msgpack"):
+            response = self.client.post(
+                "/predict/ccam/",
+                data=json.dumps({"inputs": [{"id": "1", "text": "Test"}]}),
+                content_type="application/json",
+                HTTP_AUTHORIZATION="Token {}".format(self.token),
+            )
+
+        self.assertEqual(
+            response.json(),
+            {"predictions": [{"id": "1", "ccam_codes": ["XXXTEST"], "status": "done"}]},
+        )
+        self.assertTrue(rpush.call_args[0][1].startswith(MAGIC))
+
+    @mock.patch("redis.Redis.rpush")
+    @mock.patch("redis.Redis.blpop")
+    def test_service_hint(self, blpop, rpush):
+        """Test if the service id passed by the client is sent to the worker."""
+
+        blpop.side_effect = reply_with(
+            rpush, [{"labels": ["XXXTEST"]}, {"labels": ["YYYTEST"]}]
+        )
+
+        response = self.client.post(
+            "/predict/ccam/",
+            data=json.dumps(
+                {"inputs": [{"text": "Test 1", "service": "12"}, {"text": "Test 2"}]}
+            ),
+            content_type="application/json",
+            HTTP_AUTHORIZATION="Token {}".format(self.token),
+        )
+
+        self.assertEqual(response.status_code, 200)
+        jobs = pushed_jobs(rpush)
+        self.assertEqual(jobs[0]["service"], "12")
+        self.assertNotIn("service", jobs[1])
+
+    @mock.patch("redis.Redis.rpush")
+    @mock.patch("redis.Redis.blpop")
+    def test_prediction_timeout(self, blpop, rpush):
+        """Test if the request fails when predictions are not ready in time."""
+
+        blpop.return_value = None
+
+        with mock.patch("time.time", return_value=1000.0):
+            response = self.client.post(
+                "/predict/ccam/?timeout=2.5",
+                data=json.dumps({"inputs": [{"text": "Test"}]}),
+                content_type="application/json",
+                HTTP_AUTHORIZATION="Token {}".format(self.token),
+            )
+
+        self.assertEqual(response.status_code, 504)
+        job = json.loads(rpush.call_args[0][1])
+        self.assertEqual(job["deadline"], 1002.5)
+        blpop.assert_called_once_with(job["reply_to"], timeout=2.5)
+
+        # timeout above the limit
+        response = self.client.post(
+            "/predict/ccam/?timeout={}".format(settings.PREDICT_MAX_TIMEOUT + 1),
+            data=json.dumps({"inputs": [{"text": "Test"}]}),
+            content_type="application/json",
+            HTTP_AUTHORIZATION="Token {}".format(self.token),
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("timeout", response.json())
+
+        # the jobs are not sent when nobody waits for their results
+        response = self.client.post(
+            "/predict/ccam/?timeout=0",
+            data=json.dumps({"inputs": [{"text": "Test"}]}),
+            content_type="application/json",
+            HTTP_AUTHORIZATION="Token {}".format(self.token),
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("timeout", response.json())
+        # a doorbell and a message
+        self.assertEqual(rpush.call_count, 2)
+
+    @mock.patch("redis.Redis.rpush")
+    def test_predict_asynchronous_many_inputs(self, rpush):
+        """Test creating the database entries for many asynchronous inputs."""
+
+        Prediction.objects.create(id="test-1", task="severity", status="done")
+
+        inputs = [{"id": "test-{}".format(i), "text": "Test"} for i in range(5)]
+        response = self.client.post(
+            "/predict/ccam/?asynch=1",
+            data=json.dumps({"inputs": inputs}),
+            content_type="application/json",
+            HTTP_AUTHORIZATION="Token {}".format(self.token),
+        )
+
+        self.assertEqual(response.status_code, 200)
+        # a doorbell and a message
+        self.assertEqual(rpush.call_count, 2)
+        self.assertEqual(Prediction.objects.count(), 5)
+        for i in range(5):
+            instance = Prediction.objects.get(id="test-{}".format(i))
+            self.assertEqual(instance.task, "ccam")
+            self.assertEqual(instance.status, "queued")
+
+    @mock.patch("redis.Redis.rpush")
+    @mock.patch("redis.Redis.blpop")
+    def test_identical_inputs(self, blpop, rpush):
+        """Test if identical inputs of a request are predicted once."""
+
+        blpop.side_effect = reply_with(
+            rpush, [{"labels": ["XXXTEST"]}, {"labels": ["YYYTEST"]}]
+        )
+
+        inputs = [{"text": "Test 1"}, {"text": "Test 2"}, {"text": " Test  1"}]
+        response = self.client.post(
+            "/predict/ccam/",
+            data=json.dumps({"inputs": inputs}),
+            content_type="application/json",
+            HTTP_AUTHORIZATION="Token {}".format(self.token),
+        )
+
+        self.assertEqual(response.status_code, 200)
+        predictions = response.json()["predictions"]
+        self.assertEqual(
+            [p["ccam_codes"] for p in predictions],
+            [["XXXTEST"], ["YYYTEST"], ["XXXTEST"]],
+        )
+        self.assertEqual(len({p["id"] for p in predictions}), 3)
+        self.assertEqual(len(pushed_jobs(rpush)), 2)
+
+        # the worker saves the results of the duplicates
+        rpush.reset_mock()
+        inputs = [{"id": "a", "text": "Test"}, {"id": "b", "text": "Test"}]
+        response = self.client.post(
+            "/predict/ccam/?asynch=1",
+            data=json.dumps({"inputs": inputs}),
+            content_type="application/json",
+            HTTP_AUTHORIZATION="Token {}".format(self.token),
+        )
+
+        rpush.assert_called_with(
+            tenant_queue(bulk_queue(settings.REDIS_SURGERY_QUEUE), self.user.pk),
+            json.dumps({"id": "a", "text": "Test", "persist": True, "duplicates": ["b"]}),
+        )
+        self.assertEqual(Prediction.objects.filter(status="queued").count(), 2)
+
+    @mock.patch("redis.Redis.evalsha")
+    @mock.patch("redis.Redis.rpush")
+    @mock.patch("redis.Redis.blpop")
+    def test_inflight_inputs(self, blpop, rpush, evalsha):
+        """Test waiting for the jobs of identical documents sent by other requests."""
+
+        # the first document is in flight, the second is sent as a leader
+        evalsha.return_value = [0, 1]
+        # the worker replies to the leader and the waiter
+        results = [
+            {"id": "leader", "labels": ["YYYTEST"], "status": "done"},
+            {"id": "waiter", "labels": ["XXXTEST"], "status": "done"},
+        ]
+        blpop.side_effect = lambda key, timeout: (key, json.dumps(results).encode())
+
+        inputs = [{"id": "waiter", "text": "Test 1"}, {"id": "leader", "text": "Test 2"}]
+        response = self.client.post(
+            "/predict/ccam/",
+            data=json.dumps({"inputs": inputs}),
+            content_type="application/json",
+            HTTP_AUTHORIZATION="Token {}".format(self.token),
+        )
+
+        self.assertEqual(response.status_code, 200)
+        # the documents are registered before the jobs are pushed
+        _, numkeys, *args = evalsha.call_args_list[0][0]
+        self.assertEqual(numkeys, 4)
+        inflight_key = args[2]
+        self.assertTrue(inflight_key.startswith(settings.REDIS_INFLIGHT_PREFIX))
+        waiter = json.loads(args[numkeys + 3])
+        self.assertEqual(waiter, {"id": "waiter", "reply_to": mock.ANY})
+
+        rpush.assert_called_with(
+            tenant_queue(settings.REDIS_SURGERY_QUEUE, self.user.pk), mock.ANY
+        )
+        job = json.loads(rpush.call_args[0][1])
+        self.assertEqual(job["id"], "leader")
+        self.assertEqual(job["inflight"], inflight_key)
+        self.assertEqual(job["reply_to"], waiter["reply_to"])
+        self.assertEqual(
+            response.json(),
+            {
+                "predictions": [
+                    {"id": "waiter", "ccam_codes": ["XXXTEST"], "status": "done"},
+                    {"id": "leader", "ccam_codes": ["YYYTEST"], "status": "done"},
+                ]
+            },
+        )
+
     def test_ccam_prediction_view(self):
         """Test retrieving persisted CCAM prediction."""
 
@@ -329,3 +715,148 @@ class TestPredictAPI(TestCase):
                 "status": "done",
             },
         )
+
+    @mock.patch("predict.views.AdmissionControl.admit")
+    @mock.patch("redis.Redis.rpush")
+    def test_admission_control(self, rpush, admit):
+        """Test rejecting the requests when the queue is full or the user sends
+        too many documents."""
+
+        admit.return_value = ("depth", 3)
+        response = self.client.post(
+            "/predict/ccam/",
+            data=json.dumps({"inputs": [{"text": "Test 1"}, {"text": "Test 2"}]}),
+            content_type="application/json",
+            HTTP_AUTHORIZATION="Token {}".format(self.token),
+        )
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "3")
+        self.assertIn("Too many predictions", response.json()["detail"])
+        admit.assert_called_once_with(
+            settings.REDIS_SURGERY_QUEUE, settings.REDIS_SURGERY_QUEUE, self.user.pk, 1, 2
+        )
+        rpush.assert_not_called()
+
+        admit.reset_mock()
+        admit.return_value = ("rate", 20)
+        response = self.client.post(
+            "/predict/ccam/?asynch=1",
+            data=json.dumps({"inputs": [{"id": "rejected", "text": "Test"}]}),
+            content_type="application/json",
+            HTTP_AUTHORIZATION="Token {}".format(self.token),
+        )
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "20")
+        admit.assert_called_once_with(
+            settings.REDIS_SURGERY_QUEUE,
+            bulk_queue(settings.REDIS_SURGERY_QUEUE),
+            self.user.pk,
+            1,
+            1,
+        )
+        rpush.assert_not_called()
+        self.assertFalse(Prediction.objects.filter(id="rejected").exists())
+
+    @mock.patch("redis.Redis.zcount")
+    def test_readiness(self, zcount):
+        """Test checking if the workers are ready."""
+
+        surgery = settings.REDIS_SURGERY_QUEUE
+        severity = settings.REDIS_SEVERITY_LEVEL_QUEUE
+        # live workers per heartbeat key
+        counts = {
+            settings.WORKER_HEARTBEAT_PREFIX + surgery: 2,
+            settings.WORKER_HEARTBEAT_PREFIX + severity: 2,
+        }
+        zcount.side_effect = lambda key, min, max: counts.get(key, 0)
+        response = self.client.get("/predict/ready/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json(), {"ready": True, "workers": {"ccam": 2, "severity": 2}}
+        )
+        zcount.assert_any_call(
+            settings.WORKER_HEARTBEAT_PREFIX + settings.REDIS_SURGERY_QUEUE,
+            mock.ANY,
+            "+inf",
+        )
+
+        counts[settings.WORKER_HEARTBEAT_PREFIX + severity] = 0
+        response = self.client.get("/predict/ready/")
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(
+            response.json(), {"ready": False, "workers": {"ccam": 2, "severity": 0}}
+        )
+
+        # routers without service workers
+        counts[settings.WORKER_HEARTBEAT_PREFIX + severity] = 1
+        counts[settings.WORKER_ROUTER_PREFIX + surgery] = 1
+        response = self.client.get("/predict/ready/")
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(
+            response.json(),
+            {
+                "ready": False,
+                "workers": {"ccam": 2, "severity": 1},
+                "service_workers": {"ccam": 0},
+            },
+        )
+
+        counts[settings.WORKER_SERVICES_PREFIX + surgery] = 3
+        response = self.client.get("/predict/ready/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["service_workers"], {"ccam": 3})
+
+    @mock.patch("redis.client.Pipeline.execute", autospec=True)
+    def test_queues(self, execute):
+        """Test showing the messages waiting per user."""
+
+        other = User.objects.create(
+            username="otheruser", email="other@email.com", is_active=True
+        )
+        depths = {
+            settings.REDIS_SURGERY_QUEUE: 3,
+            bulk_queue(settings.REDIS_SURGERY_QUEUE): 40,
+            tenant_queue(settings.REDIS_SURGERY_QUEUE, self.user.pk): 1,
+            tenant_queue(settings.REDIS_SURGERY_QUEUE, other.pk): 2,
+            tenant_queue(bulk_queue(settings.REDIS_SURGERY_QUEUE), other.pk): 40,
+        }
+        execute.side_effect = lambda pipe: [
+            depths.get(args[1], 0) for args, _ in pipe.command_stack
+        ]
+
+        response = self.client.get(
+            "/predict/queues/", HTTP_AUTHORIZATION="Token {}".format(self.token)
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json(),
+            {
+                "ccam": {
+                    "depth": 3,
+                    "bulk_depth": 40,
+                    "tenants": {
+                        "testuser": {"depth": 1, "bulk_depth": 0},
+                        "otheruser": {"depth": 2, "bulk_depth": 40},
+                    },
+                },
+                "severity": {"depth": 0, "bulk_depth": 0, "tenants": {}},
+            },
+        )
+
+        # the other users only see their own messages
+        token = Token.objects.create(user=other)
+        response = self.client.get(
+            "/predict/queues/", HTTP_AUTHORIZATION="Token {}".format(token.key)
+        )
+
+        self.assertEqual(
+            response.json()["ccam"]["tenants"],
+            {"otheruser": {"depth": 2, "bulk_depth": 40}},
+        )
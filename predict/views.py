@@ -1,18 +1,22 @@
 import json
+import math
 import time
+from collections import OrderedDict
 import uuid
 import sys
 import redis
 from django.shortcuts import render
 from django.conf import settings
+from django.db import transaction
 from drf_yasg.utils import swagger_auto_schema
 from rest_framework import status
 from rest_framework import generics
 from rest_framework.decorators import schema
+from rest_framework.permissions import AllowAny
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.schemas import AutoSchema
-from rest_framework.exceptions import APIException
+from rest_framework.exceptions import APIException, Throttled
 
 from .serializers import (
     CCAMPredictionSerializer,
@@ -23,7 +27,18 @@ from .serializers import (
     SeveritySerializer,
 )
 
+from .admission import AdmissionControl
+from .cache import InflightRegistry, ResultCache, normalize_text
+from .messages import decode, encode
 from .models import Prediction
+from users.models import User
+from .queues import (
+    DOORBELL,
+    JOIN_RING_SCRIPT,
+    bulk_queue,
+    tenant_queue,
+    tenants_key,
+)
 
 import logging
 
@@ -40,11 +55,23 @@ class RedisException(APIException):
     default_code = "redis_error"
 
 
+class PredictionTimeout(APIException):
+    status_code = 504
+    default_detail = "Prediction did not finish before the timeout."
+    default_code = "prediction_timeout"
+
+
+class QueueFull(Throttled):
+    default_detail = "Too many predictions are waiting to be processed."
+    default_code = "queue_full"
+
+
 class RedisClient:
     """Wrapper for redis to handle exceptions."""
 
     def __init__(self):
         self.db = redis.Redis(host=settings.REDIS_HOST)
+        self._join_ring_script = self.db.register_script(JOIN_RING_SCRIPT)
 
     def _rpush_safe(self, *args):
         try:
@@ -56,21 +83,165 @@ class RedisClient:
     def push(self, *args):
         self._rpush_safe(*args)
 
-    def _mget_safe(self, *args):
+    def push_tenant(self, queue, tenant, messages):
+        """Push the messages to the sub-queue of a tenant (see tenant_queue).
+
+        A doorbell per message is pushed to the queue and the tenant joins the
+        back of the ring of the active tenants in the same transaction. The
+        doorbells wake up the workers, which pop the messages of the tenants in
+        turn."""
+
         try:
-            data = self.db.mget(*args)
+            pipe = self.db.pipeline()
+            pipe.rpush(queue, *[DOORBELL] * len(messages))
+            pipe.rpush(tenant_queue(queue, tenant), *messages)
+            self._join_ring_script(
+                keys=[tenants_key(queue)], args=[tenant], client=pipe
+            )
+            pipe.execute()
         except redis.RedisError:
             logger.error("Unexpected redis error: %s", sys.exc_info()[0])
             raise RedisException()
-        return data
 
-    def poll(self, keys):
-        data = self._mget_safe(keys)
-        while None in data:
-            time.sleep(0.01)
-            data = self._mget_safe(keys)
+    def _blpop_safe(self, *args, **kwargs):
+        try:
+            data = self.db.blpop(*args, **kwargs)
+        except redis.RedisError:
+            logger.error("Unexpected redis error: %s", sys.exc_info()[0])
+            raise RedisException()
         return data
 
+    def wait_results(self, reply_key, keys, deadline):
+        """Block until the workers send the results for all keys to reply_key.
+
+        Each reply is a JSON list of results with their ids, so that the view
+        wakes up only once per batch processed by a worker. Raises
+        PredictionTimeout if the results are not there at the deadline."""
+
+        results = {}
+        missing = set(keys)
+        while missing:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise PredictionTimeout()
+            # redis treats timeouts rounded down to 0 ms as infinite
+            data = self._blpop_safe(reply_key, timeout=max(remaining, 0.01))
+            if data is None:
+                raise PredictionTimeout()
+            for result in decode(data[1]):
+                results[result["id"]] = result
+            missing.difference_update(results)
+        return [results[key] for key in keys]
+
+    def count_workers(self, queue, prefix=None):
+        """Return the number of workers with a recent heartbeat for the queue.
+
+        prefix: key prefix of the heartbeats (WORKER_HEARTBEAT_PREFIX by default)"""
+
+        try:
+            return self.db.zcount(
+                (prefix or settings.WORKER_HEARTBEAT_PREFIX) + queue,
+                time.time() - settings.WORKER_HEARTBEAT_TTL,
+                "+inf",
+            )
+        except redis.RedisError:
+            logger.error("Unexpected redis error: %s", sys.exc_info()[0])
+            raise RedisException()
+
+    def admit(self, queue, lane, tenant, documents):
+        """Check that the documents of a user can be queued in a lane of the queue
+        (see AdmissionControl).
+
+        Raises QueueFull or Throttled (429) with the number of seconds after
+        which the request should be retried."""
+
+        messages = math.ceil(documents / settings.PREDICT_CHUNK_SIZE)
+        try:
+            rejection = AdmissionControl(self.db).admit(
+                queue, lane, tenant, messages, documents
+            )
+        except redis.RedisError:
+            logger.error("Unexpected redis error: %s", sys.exc_info()[0])
+            raise RedisException()
+        if rejection is None:
+            return
+        reason, retry_after = rejection
+        logger.warning(
+            "rejecting %d documents of user %s for %s (%s)",
+            documents,
+            tenant,
+            lane,
+            reason,
+        )
+        if reason == "depth":
+            raise QueueFull(wait=retry_after)
+        raise Throttled(wait=retry_after)
+
+    def queue_depths(self, queues, tenants):
+        """Return the number of messages waiting in each queue and in the
+        sub-queues of the tenants, as (depths, {tenant: depths})."""
+
+        try:
+            pipe = self.db.pipeline(transaction=False)
+            for queue in queues:
+                pipe.llen(queue)
+                for tenant in tenants:
+                    pipe.llen(tenant_queue(queue, tenant))
+            lengths = iter(pipe.execute())
+        except redis.RedisError:
+            logger.error("Unexpected redis error: %s", sys.exc_info()[0])
+            raise RedisException()
+        depths = []
+        tenant_depths = {tenant: [] for tenant in tenants}
+        for _ in queues:
+            depths.append(next(lengths))
+            for tenant in tenants:
+                tenant_depths[tenant].append(next(lengths))
+        return depths, tenant_depths
+
+    def cached_results(self, queue, inputs):
+        """Return the cached results of the inputs (None if missing).
+
+        The cache is skipped if it is not available, since the workers can
+        still process the inputs."""
+
+        try:
+            cache = ResultCache(self.db, queue)
+            version = cache.get_version()
+            if version is None:
+                return [None] * len(inputs)
+            return cache.get_many(
+                version, [(i["text"], i.get("service")) for i in inputs]
+            )
+        except redis.RedisError:
+            logger.warning("result cache not available: %s", sys.exc_info()[0])
+            return [None] * len(inputs)
+
+    def register_inflight(self, queue, inputs, waiters, deadline=None):
+        """Register the inputs as in flight (see InflightRegistry.register).
+
+        Returns the in flight key and status of each input. The inputs are
+        processed independently if redis is not available."""
+
+        registry = InflightRegistry(self.db, queue)
+        keys = [registry.key(i["text"], i.get("service")) for i in inputs]
+        try:
+            statuses = registry.register(
+                keys, [json.dumps(waiter) for waiter in waiters], deadline
+            )
+        except redis.RedisError:
+            logger.warning("in flight registry not available: %s", sys.exc_info()[0])
+            statuses = [-1] * len(keys)
+        return list(zip(keys, statuses))
+
+    def release_inflight(self, queue, keys):
+        "Remove the documents whose jobs could not be sent from the in flight documents."
+
+        try:
+            InflightRegistry(self.db, queue).claim(keys)
+        except redis.RedisError:
+            logger.warning("in flight registry not available: %s", sys.exc_info()[0])
+
     def mget(self, *args):
         try:
             self.db.mget(*args)
@@ -93,55 +264,186 @@ class PredictGenericView(APIView):
 
         query = PredictQuerySerializer(data=request.query_params)
         if not query.is_valid():
-            return Response(query.errors)
+            return Response(query.errors, status=status.HTTP_400_BAD_REQUEST)
         asynchronous = query.validated_data.get("asynch")
+        deadline = time.time() + query.validated_data.get("timeout")
 
         input_data = request_serializer(data=request.data)
-        if input_data.is_valid():
-            request_ids = []
-            prediction_requests = []
-            inputs = input_data.validated_data["inputs"]
-            for input_data in inputs:
-                request_id = input_data.get("id", str(uuid.uuid4()))
-                request_ids.append(request_id)
-                request_data = {"id": request_id, **input_data}
-                if asynchronous:
-                    request_data["persist"] = True
-                prediction_requests.append(json.dumps(request_data))
+        if not input_data.is_valid():
+            return Response(input_data.errors, status=status.HTTP_400_BAD_REQUEST)
 
+        inputs = input_data.validated_data["inputs"]
+        request_ids = [i.get("id", str(uuid.uuid4())) for i in inputs]
+        reply_key = settings.REDIS_REPLY_PREFIX + str(uuid.uuid4())
+
+        # the identical documents of the request are predicted once, for the
+        # request id of their first occurrence
+        documents = OrderedDict()
+        for request_id, input_data in zip(request_ids, inputs):
+            doc = (normalize_text(input_data["text"]), input_data.get("service"))
+            documents.setdefault(doc, []).append((request_id, input_data))
+        first_ids = {}
+        for occurrences in documents.values():
+            for request_id, _ in occurrences:
+                first_ids[request_id] = occurrences[0][0]
+
+        # results of the documents found in the cache
+        results = {}
+        unique_inputs = [occurrences[0] for occurrences in documents.values()]
+        cached_results = db.cached_results(queue, [i for _, i in unique_inputs])
+        for (request_id, _), cached in zip(unique_inputs, cached_results):
+            if cached is not None:
+                results[request_id] = {**cached, "status": "done"}
+        if results:
+            logger.info("found {} results in the cache".format(len(results)))
+
+        pending = [doc for doc in unique_inputs if doc[0] not in results]
+
+        # the asynchronous jobs do not delay the synchronous ones
+        lane = bulk_queue(queue) if asynchronous else queue
+        if pending:
+            # shed the load before anything is registered for the request
+            db.admit(queue, lane, request.user.pk, len(pending))
+        duplicates = {
+            occurrences[0][0]: [request_id for request_id, _ in occurrences[1:]]
+            for occurrences in documents.values()
+        }
+        waiters = []
+        for request_id, _ in pending:
+            waiter = {"id": request_id}
+            if asynchronous:
+                waiter["persist"] = True
+                if duplicates[request_id]:
+                    waiter["duplicates"] = duplicates[request_id]
+            else:
+                waiter["reply_to"] = reply_key
+            waiters.append(waiter)
+
+        if asynchronous:
+            # the entries must exist before a worker picks up the jobs
+            self.create_predictions(
+                request_ids,
+                {i: results[first_ids[i]] for i in request_ids if first_ids[i] in results},
+            )
+
+        # the documents already in flight (in the same lane) wait for the results
+        # of their leader
+        inflight = db.register_inflight(
+            lane,
+            [i for _, i in pending],
+            waiters,
+            deadline=None if asynchronous else deadline,
+        )
+        prediction_requests = []
+        leader_keys = []
+        for waiter, (_, input_data), (key, inflight_status) in zip(
+            waiters, pending, inflight
+        ):
+            if inflight_status == 0:
+                continue
+            request_data = {"id": waiter["id"], **input_data}
+            if asynchronous:
+                request_data.update(waiter)
+            else:
+                request_data["reply_to"] = reply_key
+                request_data["deadline"] = deadline
+            if inflight_status == 1:
+                request_data["inflight"] = key
+                leader_keys.append(key)
+            prediction_requests.append(request_data)
+        n_waiting = len(pending) - len(prediction_requests)
+        if n_waiting:
+            logger.info("{} documents wait for identical jobs".format(n_waiting))
+
+        if prediction_requests:
+            messages = self.pack_jobs(prediction_requests)
             logger.info(
-                "sending {} jobs to redis queue {}".format(
-                    len(prediction_requests), queue
+                "sending {} jobs in {} messages to redis queue {}".format(
+                    len(prediction_requests), len(messages), lane
                 )
             )
-            db.push(queue, *prediction_requests)
-        else:
-            return Response(input_data.errors, status=status.HTTP_400_BAD_REQUEST)
-
+            try:
+                # the requests of each user are queued separately
+                db.push_tenant(lane, request.user.pk, messages)
+            except RedisException:
+                db.release_inflight(lane, leader_keys)
+                if asynchronous:
+                    Prediction.objects.filter(id__in=request_ids).exclude(
+                        id__in=results
+                    ).update(
+                        status="error", error_message=RedisException.default_detail
+                    )
+                raise
+
+        pending_ids = [request_id for request_id, _ in pending]
         if asynchronous:
             # return immediately
-            predictions = ['{"status": "queued"}'] * len(request_ids)
-            for request_id in request_ids:
-                instance, _ = Prediction.objects.get_or_create(id=request_id)
-                instance.task = self.task
-                instance.status = "queued"
-                instance.save()
-        else:
+            results.update(dict.fromkeys(pending_ids, {"status": "queued"}))
+        elif pending_ids:
             # wait for results
-            predictions = db.poll(request_ids)
-
-        def format_response(serialized_data):
-            d = json.loads(serialized_data)
-            return d
+            predictions = db.wait_results(reply_key, pending_ids, deadline)
+            results.update(zip(pending_ids, predictions))
 
         results = [
-            {"id": request_id, **format_response(v)}
-            for request_id, v in zip(request_ids, predictions)
+            {**results[first_ids[request_id]], "id": request_id}
+            for request_id in request_ids
         ]
         prediction = prediction_serializer({"predictions": results})
 
         return Response(prediction.data)
 
+    @staticmethod
+    def pack_jobs(jobs):
+        """Serialize the jobs in messages of at most PREDICT_CHUNK_SIZE jobs.
+
+        The jobs of a chunk are sent in an envelope, with the metadata they
+        share set once."""
+
+        messages = []
+        chunk_size = settings.PREDICT_CHUNK_SIZE
+        for start in range(0, len(jobs), chunk_size):
+            chunk = jobs[start : start + chunk_size]
+            if len(chunk) == 1:
+                messages.append(encode(chunk[0]))
+                continue
+            shared = {
+                key: chunk[0][key]
+                for key in ("reply_to", "deadline", "persist")
+                if key in chunk[0]
+            }
+            envelope = {
+                "jobs": [
+                    {k: v for k, v in job.items() if k not in shared} for job in chunk
+                ],
+                **shared,
+            }
+            messages.append(encode(envelope))
+        return messages
+
+    def create_predictions(self, request_ids, results):
+        """Create (or reset) the queued database entries in bulk.
+
+        The entries of the results found in the cache are created as done."""
+
+        with transaction.atomic():
+            existing = Prediction.objects.filter(id__in=request_ids)
+            existing_ids = set(existing.values_list("id", flat=True))
+            existing.update(task=self.task, status="queued")
+            new_ids = dict.fromkeys(i for i in request_ids if i not in existing_ids)
+            Prediction.objects.bulk_create(
+                [Prediction(id=i, task=self.task, status="queued") for i in new_ids]
+            )
+
+            # one update per distinct labels
+            cached_ids = {}
+            for request_id, result in results.items():
+                label_string = ",".join(result["labels"])
+                cached_ids.setdefault(label_string, []).append(request_id)
+            for label_string, ids in cached_ids.items():
+                Prediction.objects.filter(id__in=ids).update(
+                    status="done", label_string=label_string, error_message=None
+                )
+
 
 class CCAMCodesView(PredictGenericView):
     """Prediction of CCAM codes from CROs."""
@@ -177,6 +479,76 @@ class SeverityLevelsView(PredictGenericView):
         return super().post(request, *args, *kwargs)
 
 
+class ReadinessView(APIView):
+    """Check if there are workers ready to process the prediction requests."""
+
+    # used by health checks, which are not authenticated
+    permission_classes = (AllowAny,)
+
+    queues = {"ccam": SURGERY_QUEUE, "severity": SEVERITY_QUEUE}
+
+    def get(self, request, *args, **kwargs):
+        """Return the number of ready workers per task.
+
+        When a task is served by routers (split CCAM deployment), the number of
+        ready workers of its services is returned too. The response status is
+        503 if some task has no ready worker, or routers but no service worker."""
+
+        workers = {}
+        service_workers = {}
+        for task, queue in self.queues.items():
+            workers[task] = db.count_workers(queue)
+            # the routed documents wait for the workers of their service
+            if db.count_workers(queue, settings.WORKER_ROUTER_PREFIX):
+                service_workers[task] = db.count_workers(
+                    queue, settings.WORKER_SERVICES_PREFIX
+                )
+        ready = all(workers.values()) and all(service_workers.values())
+        data = {"ready": ready, "workers": workers}
+        if service_workers:
+            data["service_workers"] = service_workers
+        return Response(
+            data,
+            status=status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE,
+        )
+
+
+class QueuesView(APIView):
+    """Show the prediction jobs waiting in the queues."""
+
+    queues = ReadinessView.queues
+
+    def get(self, request, *args, **kwargs):
+        """Return the number of messages waiting per task and per user.
+
+        The synchronous and asynchronous (bulk) messages are counted separately.
+        The administrators see the messages of all users, the other users only
+        their own messages."""
+
+        if request.user.is_admin():
+            users = list(User.objects.all())
+        else:
+            users = [request.user]
+        lanes = [
+            lane for queue in self.queues.values() for lane in (queue, bulk_queue(queue))
+        ]
+        depths, tenant_depths = db.queue_depths(lanes, [user.pk for user in users])
+
+        tasks = {}
+        for i, task in enumerate(self.queues):
+            tenants = {}
+            for user in users:
+                depth, bulk_depth = tenant_depths[user.pk][2 * i : 2 * i + 2]
+                if depth or bulk_depth:
+                    tenants[user.username] = {"depth": depth, "bulk_depth": bulk_depth}
+            tasks[task] = {
+                "depth": depths[2 * i],
+                "bulk_depth": depths[2 * i + 1],
+                "tenants": tenants,
+            }
+        return Response(tasks)
+
+
 class CCAMPredictionView(generics.RetrieveAPIView):
     queryset = Prediction.objects.filter(task="ccam")
     serializer_class = CCAMSerializer
@@ -222,4 +222,63 @@ SWAGGER_SETTINGS = {
 
 REDIS_HOST = "redis"
 REDIS_SURGERY_QUEUE = "surgery_queue"
-REDIS_SEVERITY_LEVEL_QUEUE = "severity_queue"
\ No newline at end of file
+REDIS_SEVERITY_LEVEL_QUEUE = "severity_queue"
+# prefix of the lists where workers send the results of synchronous requests
+REDIS_REPLY_PREFIX = "reply:"
+# expiry (in seconds) of the results of synchronous predictions
+REDIS_RESULT_TTL = 3600
+
+# workers refresh their heartbeat (sorted set per queue) every interval seconds
+# and are considered dead if it is older than TTL seconds
+WORKER_HEARTBEAT_PREFIX = "workers:"
+WORKER_HEARTBEAT_INTERVAL = 5
+WORKER_HEARTBEAT_TTL = 15
+# heartbeats of the two stages of the split CCAM deployment (per base queue): the
+# routers and the workers of the services
+WORKER_ROUTER_PREFIX = "routers:"
+WORKER_SERVICES_PREFIX = "service-workers:"
+
+# default and maximum time (in seconds) to wait for synchronous predictions
+PREDICT_TIMEOUT = 60
+PREDICT_MAX_TIMEOUT = 600
+# shared cache of sentence embeddings (CRHSeverityClassifier), expiry in seconds
+REDIS_EMBEDDING_PREFIX = "embeddings:"
+EMBEDDING_CACHE_TTL = 7 * 24 * 3600
+
+# cache of the prediction results (per queue and model version), expiry in
+# seconds and maximum number of entries per queue (0 to disable the cache)
+RESULT_CACHE_PREFIX = "results:"
+RESULT_CACHE_TTL = 7 * 24 * 3600
+RESULT_CACHE_MAX_ENTRIES = 100000
+
+# documents being predicted, identical documents sent meanwhile wait for the
+# same job; lease (in seconds) of the asynchronous jobs, which the workers renew
+# while they process them (the documents queued for longer may be predicted
+# twice), and expiry of their waiters
+REDIS_INFLIGHT_PREFIX = "inflight:"
+INFLIGHT_LEASE = 600
+INFLIGHT_TTL = 24 * 3600
+
+# format of the queued jobs and results ("json" or "msgpack"), the workers accept
+# both; msgpack messages longer than MESSAGE_COMPRESS_MIN_SIZE bytes are compressed
+REDIS_MESSAGE_FORMAT = "json"
+MESSAGE_COMPRESS_MIN_SIZE = 4096
+
+# the jobs of a request are sent to the workers in messages of at most
+# PREDICT_CHUNK_SIZE jobs (the batch size of the workers)
+PREDICT_CHUNK_SIZE = 16
+
+# admission control: maximum number of messages waiting in a queue (the limits
+# of PREDICT_MAX_QUEUE_DEPTHS override it per queue or lane, e.g.
+# "surgery_queue:bulk"), 0 for no limit
+PREDICT_MAX_QUEUE_DEPTH = 10000
+PREDICT_MAX_QUEUE_DEPTHS = {}
+# token bucket of each user: documents per second (0 for no limit) and burst
+REDIS_RATE_LIMIT_PREFIX = "ratelimit:"
+PREDICT_RATE_LIMIT = 0
+PREDICT_RATE_BURST = 1000
+# workers publish the number of messages they pop per second (hash per queue),
+# which estimates when the rejected requests should be retried (in seconds,
+# PREDICT_RETRY_AFTER if unknown)
+WORKER_THROUGHPUT_PREFIX = "throughput:"
+PREDICT_RETRY_AFTER = 10
@@ -21,6 +21,8 @@ from drf_yasg.views import get_schema_view
 from predict.views import (
     CCAMCodesView,
     CCAMPredictionView,
+    QueuesView,
+    ReadinessView,
     SeverityLevelsView,
     SeverityPredictionView,
 )
@@ -48,6 +50,8 @@ urlpatterns = [
     url(r"^", include(router.urls)),
     path("admin/", admin.site.urls),
     url(r"^docs/", schema_view),
+    path("predict/ready/", ReadinessView.as_view()),
+    path("predict/queues/", QueuesView.as_view()),
     path("predict/ccam/", CCAMCodesView.as_view()),
     path("predict/ccam/<str:pk>/", CCAMPredictionView.as_view()),
     path("predict/severity/", SeverityLevelsView.as_view()),
@@ -0,0 +1,141 @@
+from django.conf import settings
+import redis
+import hashlib
+import logging
+import os
+import re
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def model_version(model_path):
+    """Return an identifier of the model files in model_path.
+
+    It changes when a file of the model directory or of its subdirectories
+    (e.g. the CCAM models) is replaced, so that cached outputs of an older model
+    are not reused."""
+
+    digest = hashlib.sha1(os.path.realpath(model_path).encode())
+    for root, dirs, files in os.walk(model_path, followlinks=True):
+        # walk in a stable order
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            digest.update(
+                "{}:{}:{}".format(
+                    os.path.relpath(path, model_path), stat.st_size, stat.st_mtime
+                ).encode()
+            )
+
+    return digest.hexdigest()[:12]
+
+
+class EmbeddingCache:
+    """Bounded LRU cache of embeddings keyed by the hash of a normalized text and
+    the model version.
+
+    With shared=True, the cache is backed by redis, so that the embeddings
+    computed by one worker are reused by the others."""
+
+    def __init__(self, max_entries, version, shared=False, ttl=None):
+        """Create cache.
+
+        max_entries: number of embeddings kept in memory
+        version: model version, part of the keys
+        shared: look up the embeddings missing in memory in redis
+        ttl: expiry of the embeddings stored in redis (in seconds, by default
+            settings.EMBEDDING_CACHE_TTL)"""
+
+        self.max_entries = max_entries
+        self.version = version
+        self.ttl = ttl if ttl is not None else settings.EMBEDDING_CACHE_TTL
+        self.db = redis.Redis(host=settings.REDIS_HOST) if shared else None
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def key(self, text):
+        "Return the cache key of text."
+
+        normalized = re.sub(r"\s+", " ", text).strip().lower()
+        digest = hashlib.sha1("{}\0{}".format(self.version, normalized).encode())
+        return digest.hexdigest()
+
+    def get_many(self, keys):
+        "Return the cached embeddings of keys (None for missing keys)."
+
+        values = []
+        for key in keys:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            values.append(value)
+
+        missing = [i for i, value in enumerate(values) if value is None]
+        if missing and self.db is not None:
+            try:
+                shared = self.db.mget(
+                    [settings.REDIS_EMBEDDING_PREFIX + keys[i] for i in missing]
+                )
+            except redis.RedisError:
+                logger.warning("could not read embeddings from redis", exc_info=True)
+                shared = [None] * len(missing)
+            for i, data in zip(missing, shared):
+                if data is not None:
+                    values[i] = np.frombuffer(data, dtype=np.float32)
+                    self._add(keys[i], values[i])
+                    self.shared_hits += 1
+
+        n_missing = sum(value is None for value in values)
+        self.misses += n_missing
+        self.hits += len(values) - n_missing
+
+        return values
+
+    def set_many(self, keys, values):
+        "Store the embeddings of keys."
+
+        for key, value in zip(keys, values):
+            self._add(key, value)
+
+        if self.db is not None and keys:
+            pipe = self.db.pipeline(transaction=False)
+            for key, value in zip(keys, values):
+                pipe.set(
+                    settings.REDIS_EMBEDDING_PREFIX + key,
+                    np.asarray(value, dtype=np.float32).tobytes(),
+                    ex=self.ttl or None,
+                )
+            try:
+                pipe.execute()
+            except redis.RedisError:
+                logger.warning("could not store embeddings in redis", exc_info=True)
+
+    def _add(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    @property
+    def hit_rate(self):
+        "Fraction of the looked up keys found in the cache (memory or redis)."
+
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        "Return the cache metrics."
+
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+        }
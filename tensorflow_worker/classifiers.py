@@ -1,10 +1,12 @@
 import json
 import logging
 import os
+from collections import OrderedDict
 from itertools import groupby
 
 import joblib
 import nltk
+import numpy as np
 import tensorflow as tf
 
 from tf_codage.models import (
@@ -13,15 +15,45 @@ from tf_codage.models import (
     TFCamembertForSentenceEmbedding,
 )
 from transformers import CamembertTokenizer
-from tf_codage.data import create_sentence_dataset
+
+from .caches import EmbeddingCache, model_version
 
 logger = logging.getLogger(__name__)
 
+# signature of the traced serving functions of BERT models (any batch size and length)
+TOKENS_SPEC = tf.TensorSpec([None, None], tf.int32)
+TOKENS_SIGNATURE = [
+    {"input_ids": TOKENS_SPEC, "attention_mask": TOKENS_SPEC, "token_type_ids": TOKENS_SPEC}
+]
+
 
 class BertCCAMClassifier:
     """Run classification with transformers BERT model."""
 
     BATCH_SIZE = 16
+    # predict accepts the job metadata (service hints)
+    USES_META = True
+    # inputs are padded to the shortest bucket fitting the longest document of
+    # a batch (at most MAX_LENGTH)
+    BUCKET_LENGTHS = (32, 64, 128, 256)
+    # texts are cut to MAX_LENGTH * MAX_CHARS_PER_TOKEN characters before
+    # tokenization, since the tokens after MAX_LENGTH are dropped anyway
+    MAX_CHARS_PER_TOKEN = 20
+
+    def __init__(self, ccam_cache_mb=None, preload=False, services=None):
+        """Create classifier.
+
+        ccam_cache_mb: memory budget (in MB) of the CCAM models kept in memory,
+            the least recently used models are evicted first (None for no limit)
+        preload: load all CCAM models of the model mapping in load_model
+        services: ids of the services whose documents are classified (all by
+            default), their CCAM models are loaded in load_model"""
+
+        self.ccam_cache_bytes = ccam_cache_mb * 2 ** 20 if ccam_cache_mb else None
+        self.preload = preload
+        self.services = services
+        self._ccam_models = OrderedDict()
+        self.shared_encoder_services = set()
 
     def load_model(self, models_dir):
         "Load model."
@@ -39,10 +71,19 @@ class BertCCAMClassifier:
         self._load_tokenizer(tokenizer_path)
 
         # postpone the loading of CCAM model until service id is known
-        self._ccam_model_service = None
         self.ccam_model = None
         self.ccam_encoder = None
 
+        if self.services:
+            unknown = set(self.services).difference(self.model_mapping)
+            if unknown:
+                raise ValueError("no CCAM model for services {}".format(unknown))
+            for service_id in self.services:
+                self._get_ccam_model(self.model_mapping[service_id])
+        elif self.preload:
+            for model_path in set(self.model_mapping.values()):
+                self._get_ccam_model(model_path)
+
     def _load_ccam_model_mapping(self, path):
 
         models_dir, _ = os.path.split(path)
@@ -51,6 +92,8 @@ class BertCCAMClassifier:
             models_conf = json.load(fid)
 
         self.model_mapping = {}
+        # services whose CCAM model shares the encoder of the service model
+        self.shared_encoder_services = set()
 
         logger.debug("Loading model mapping from %s", path)
 
@@ -59,6 +102,8 @@ class BertCCAMClassifier:
             model_path = os.path.join(models_dir, ccam_model["path"])
 
             self.model_mapping[service_id] = model_path
+            if ccam_model.get("shared_encoder"):
+                self.shared_encoder_services.add(service_id)
 
         return models_conf
 
@@ -82,11 +127,11 @@ class BertCCAMClassifier:
 
     def _tokenize(self, valid_documents):
 
+        max_chars = self.MAX_LENGTH * self.MAX_CHARS_PER_TOKEN
         tokens = [
             self.tokenizer.encode_plus(
-                doc.lower(),
+                doc[:max_chars].lower(),
                 max_length=self.MAX_LENGTH,
-                pad_to_max_length=True,
                 add_special_tokens=True,
             )
             for doc in valid_documents
@@ -94,39 +139,172 @@ class BertCCAMClassifier:
 
         return tokens
 
-    def _make_dataset(self, tokens):
-        """Create a TF Dataset from a list of tokenized docs"""
+    def _bucket_length(self, length):
+        "Return the padded length of a batch whose longest document has length tokens."
+
+        for bucket_length in self.BUCKET_LENGTHS:
+            if length <= bucket_length:
+                return min(bucket_length, self.MAX_LENGTH)
+        return self.MAX_LENGTH
+
+    def _make_batches(self, tokens):
+        """Split a list of tokenized docs into batches of docs of similar length.
+
+        The docs are sorted by length, so that each batch can be padded only to
+        the bucket of its longest doc. Yields tuples of the indices of the docs
+        in the batch and the padded inputs."""
+
+        pad_values = {
+            "input_ids": self.tokenizer.pad_token_id,
+            "attention_mask": 0,
+            "token_type_ids": 0,
+        }
+
+        order = sorted(range(len(tokens)), key=lambda i: len(tokens[i]["input_ids"]))
+
+        for start in range(0, len(order), self.BATCH_SIZE):
+            indices = order[start : start + self.BATCH_SIZE]
+            length = self._bucket_length(
+                max(len(tokens[i]["input_ids"]) for i in indices)
+            )
+            inputs = {}
+            for key, pad_value in pad_values.items():
+                values = np.full((len(indices), length), pad_value, dtype=np.int32)
+                for row, i in enumerate(indices):
+                    values[row, : len(tokens[i][key])] = tokens[i][key]
+                inputs[key] = values
+            yield indices, inputs
+
+    def _run_batches(self, func, tokens):
+        "Run func on length-bucketed batches and return outputs in the original order."
+
+        outputs = [None] * len(tokens)
+        for indices, inputs in self._make_batches(tokens):
+            for i, output in zip(indices, func(inputs)):
+                outputs[i] = output
+
+        return np.array(outputs)
+
+    def _serving_function(self, model):
+        """Return the prediction function of model traced for all input shapes.
+
+        Calling it directly on NumPy arrays avoids the per-call overhead of
+        model.predict (dataset construction, retracing)."""
 
-        merged_data = {}
+        serving_function = getattr(model, "_serving_function", None)
+        if serving_function is None:
 
-        for key in ["input_ids", "attention_mask", "token_type_ids"]:
-            values = tf.constant([tok[key] for tok in tokens])
-            merged_data[key] = values
+            @tf.function(input_signature=TOKENS_SIGNATURE)
+            def serving_function(inputs):
+                output = model(inputs, training=False)
+                # transformers models return tuples
+                if isinstance(output, (tuple, list)):
+                    output = output[0]
+                return output
 
-        dataset = tf.data.Dataset.from_tensor_slices(merged_data)
-        dataset = dataset.batch(self.BATCH_SIZE)
+            model._serving_function = serving_function
 
-        return dataset
+        return serving_function
+
+    def _run_model(self, model, tokens):
+
+        serving_function = self._serving_function(model)
+        return self._run_batches(
+            lambda inputs: serving_function(inputs).numpy(), tokens
+        )
 
     def _predict_service(self, tokens):
         "Predict service id from tokenized text"
 
-        dataset = self._make_dataset(tokens)
-
-        output = self.service_model.predict(dataset)
+        output = self._run_model(self.service_model, tokens)
         service_codes = self.service_encoder.inverse_transform(output)
 
         return service_codes
 
+    def _encode(self, tokens):
+        """Run the encoder of the service model on tokenized text.
+
+        Returns the hidden state of the first token (<s>), which is the only one
+        used by the classification heads, with shape (n_docs, hidden_size)."""
+
+        encode = self._encoder_function()
+        return self._run_batches(lambda inputs: encode(inputs).numpy(), tokens)
+
+    def _encoder_function(self):
+        "Return the traced function computing the encoder output of the <s> token."
+
+        encoder = self.service_model.roberta
+        encode = getattr(encoder, "_serving_function", None)
+        if encode is None:
+
+            @tf.function(input_signature=TOKENS_SIGNATURE)
+            def encode(inputs):
+                sequence_output = encoder(inputs, training=False)[0]
+                return sequence_output[:, 0, :]
+
+            encoder._serving_function = encode
+
+        return encode
+
+    def _predict_service_head(self, features):
+        "Predict service id from the encoder output"
+
+        output = self.service_model.classifier(features[:, None, :], training=False)
+        service_codes = self.service_encoder.inverse_transform(output.numpy())
+
+        return service_codes
+
+    def _predict_ccam_head(self, features, service_id):
+        """Predict CCAM codes from the encoder output shared with the service model.
+
+        Only the classification head of the CCAM model is run."""
+
+        self._load_ccam_model(self.model_mapping[service_id])
+
+        # the head ends with the output activation of the model, its output is
+        # thresholded like the output of the full model (see _predict_ccam)
+        output = self.ccam_model.classifier(features[:, None, :], training=False)
+        indicators = output.numpy() > 0.5
+        ccam_codes = self.ccam_encoder.inverse_transform(indicators)
+
+        return ccam_codes
+
     def _load_ccam_model(self, model_path):
-        """Load CCAM model."""
+        """Load CCAM model (or take it from the cache)."""
+
+        self.ccam_model, self.ccam_encoder = self._get_ccam_model(model_path)
+
+    def _get_ccam_model(self, model_path):
+        "Return CCAM model and encoder from the LRU cache, loading them if needed."
+
+        if model_path in self._ccam_models:
+            self._ccam_models.move_to_end(model_path)
+            model, encoder, _ = self._ccam_models[model_path]
+            return model, encoder
 
         logger.debug("loading CCAM model from %s", model_path)
 
-        self.ccam_model = CamembertForMultilabelClassification.from_pretrained(
-            model_path
-        )
-        self.ccam_encoder = joblib.load(os.path.join(model_path, "encoder.joblib"))
+        model = CamembertForMultilabelClassification.from_pretrained(model_path)
+        encoder = joblib.load(os.path.join(model_path, "encoder.joblib"))
+        size = sum(int(np.prod(w.shape)) * w.dtype.size for w in model.weights)
+
+        self._ccam_models[model_path] = (model, encoder, size)
+        self._evict_ccam_models()
+
+        return model, encoder
+
+    def _evict_ccam_models(self):
+        "Remove least recently used CCAM models until they fit in the memory budget."
+
+        if self.ccam_cache_bytes is None:
+            return
+
+        total_size = sum(size for _, _, size in self._ccam_models.values())
+        # always keep the most recent model
+        while total_size > self.ccam_cache_bytes and len(self._ccam_models) > 1:
+            model_path, (_, _, size) = self._ccam_models.popitem(last=False)
+            logger.debug("evicting CCAM model %s from the cache", model_path)
+            total_size -= size
 
     def _predict_ccam(self, tokens):
         """Predict the CCAM codes with loaded model"""
@@ -135,9 +313,7 @@ class BertCCAMClassifier:
             self.ccam_model and self.ccam_encoder
         ), "CCAM model not loaded. Call _load_call_model"
 
-        dataset = self._make_dataset(tokens)
-
-        output = self.ccam_model.predict(dataset)
+        output = self._run_model(self.ccam_model, tokens)
         indicators = output > 0.5
         ccam_codes = self.ccam_encoder.inverse_transform(indicators)
 
@@ -146,26 +322,47 @@ class BertCCAMClassifier:
     def _predict_ccam_for_service(self, tokens, service_id):
         "Predict CCAM codes knowing for the given service id"
 
-        if self._ccam_model_service != service_id:
-            self._ccam_model_service = service_id
-            model_path = self.model_mapping[service_id]
-            self._load_ccam_model(model_path)
+        self._load_ccam_model(self.model_mapping[service_id])
 
         ccam_codes = self._predict_ccam(tokens)
 
         return ccam_codes
 
     def _predict(self, valid_documents):
-        "End-to-end prediction of CCAM codes from document texts"
+        """End-to-end prediction of CCAM codes from tokenized documents
 
-        texts = [d["text"] for d in valid_documents]
+        The service model is skipped for the documents with a service hint. If
+        some CCAM models share the encoder of the service model, the encoder
+        runs only once per document and only the heads run for these services."""
 
-        tokenized_docs = self._tokenize(texts)
-        service_codes = self._predict_service(tokenized_docs)
+        # the service model runs only for the documents without service hint
+        unknown_service_docs = [
+            doc for doc in valid_documents if doc["service_code"] is None
+        ]
 
-        for code, tokens, doc in zip(service_codes, tokenized_docs, valid_documents):
-            doc["service_code"] = code
-            doc["tokens"] = tokens
+        if self.shared_encoder_services:
+            encoded_docs = [
+                doc
+                for doc in valid_documents
+                if doc["service_code"] is None
+                or doc["service_code"] in self.shared_encoder_services
+            ]
+            if encoded_docs:
+                features = self._encode([doc["tokens"] for doc in encoded_docs])
+                for doc_features, doc in zip(features, encoded_docs):
+                    doc["features"] = doc_features
+            if unknown_service_docs:
+                service_codes = self._predict_service_head(
+                    np.array([doc["features"] for doc in unknown_service_docs])
+                )
+        elif unknown_service_docs:
+            service_codes = self._predict_service(
+                [doc["tokens"] for doc in unknown_service_docs]
+            )
+
+        if unknown_service_docs:
+            for code, doc in zip(service_codes, unknown_service_docs):
+                doc["service_code"] = code
 
         # group documents by service id
         sorted_documents = sorted(valid_documents, key=lambda x: x["service_code"])
@@ -175,24 +372,63 @@ class BertCCAMClassifier:
         labeled_documents = []
         for service_id, group in service_groups:
             service_docs = list(group)
-            tokens = [doc["tokens"] for doc in service_docs]
 
-            ccam_codes = self._predict_ccam_for_service(tokens, service_id)
+            if service_id in self.shared_encoder_services:
+                features = np.array([doc["features"] for doc in service_docs])
+                ccam_codes = self._predict_ccam_head(features, service_id)
+            else:
+                tokens = [doc["tokens"] for doc in service_docs]
+                ccam_codes = self._predict_ccam_for_service(tokens, service_id)
+
             for ccam, doc in zip(ccam_codes, service_docs):
                 doc["ccam_codes"] = ccam
             labeled_documents.extend(service_docs)
 
         return labeled_documents
 
-    def predict(self, documents):
-        """Make prediction for documents.
-        
-        Return list of tuples (multiple labels per document)"""
+    def warmup(self):
+        """Run synthetic inputs of all bucket shapes through the loaded models.
+
+        This traces the serving functions and allocates the buffers before the
+        first real requests."""
+
+        models = [getattr(self, "service_model", None)]
+        models += [model for model, _, _ in self._ccam_models.values()]
+        models = [model for model in models if model is not None]
+
+        lengths = {self._bucket_length(length) for length in self.BUCKET_LENGTHS}
+        lengths.add(self.MAX_LENGTH)
+
+        for length in sorted(lengths):
+            logger.debug("warming up models for inputs of length %d", length)
+            shape = (self.BATCH_SIZE, length)
+            inputs = {
+                "input_ids": np.full(shape, self.tokenizer.pad_token_id, np.int32),
+                "attention_mask": np.ones(shape, np.int32),
+                "token_type_ids": np.zeros(shape, np.int32),
+            }
+            for model in models:
+                self._serving_function(model)(inputs)
+            if self.shared_encoder_services:
+                self._encoder_function()(inputs)
+
+    def preprocess(self, documents, metas=None):
+        """Validate and tokenize documents.
+
+        metas: optional list of job metadata, whose "service" field is used as
+        service id instead of predicting it with the service model.
+
+        It does not use the models, so it can run concurrently with
+        predict_preprocessed on another batch."""
 
         results = [{} for _ in documents]
         valid_documents = []
 
-        documents = [{"id": i, "text": doc} for i, doc in enumerate(documents)]
+        metas = metas or [{} for _ in documents]
+        documents = [
+            {"id": i, "text": doc, "service_code": self._service_hint(meta)}
+            for i, (doc, meta) in enumerate(zip(documents, metas))
+        ]
 
         # remove invalid documents
         for doc in documents:
@@ -203,8 +439,32 @@ class BertCCAMClassifier:
             else:
                 valid_documents.append(doc)
 
+        # the documents routed by another worker are already tokenized
+        for doc, meta in zip(documents, metas):
+            if "tokens" in meta:
+                input_ids = meta["tokens"]
+                doc["tokens"] = {
+                    "input_ids": input_ids,
+                    "attention_mask": [1] * len(input_ids),
+                    "token_type_ids": [0] * len(input_ids),
+                }
+        untokenized_docs = [d for d in valid_documents if "tokens" not in d]
+        tokenized_docs = self._tokenize([d["text"] for d in untokenized_docs])
+        for tokens, doc in zip(tokenized_docs, untokenized_docs):
+            doc["tokens"] = tokens
+
+        return results, valid_documents
+
+    def predict_preprocessed(self, preprocessed):
+        "Make prediction for the output of preprocess."
+
+        results, valid_documents = preprocessed
+
         logger.info("classifier received %d valid inputs", len(valid_documents))
 
+        if not valid_documents:
+            return results
+
         # run prediction
         docs_with_labels = self._predict(valid_documents)
 
@@ -214,11 +474,64 @@ class BertCCAMClassifier:
 
         return results
 
+    def predict(self, documents, metas=None):
+        """Make prediction for documents.
+        
+        Return list of tuples (multiple labels per document)"""
+
+        return self.predict_preprocessed(self.preprocess(documents, metas))
+
+    def route(self, documents, metas=None):
+        """Predict only the service of documents (first stage of the split deployment).
+
+        Returns for each document its service id and tokens (input ids), or
+        its error. The documents with a service hint are not predicted."""
+
+        results, valid_documents = self.preprocess(documents, metas)
+
+        unknown_service_docs = [
+            doc for doc in valid_documents if doc["service_code"] is None
+        ]
+        if unknown_service_docs:
+            service_codes = self._predict_service(
+                [doc["tokens"] for doc in unknown_service_docs]
+            )
+            for code, doc in zip(service_codes, unknown_service_docs):
+                doc["service_code"] = code
+
+        for doc in valid_documents:
+            result = results[doc["id"]]
+            if doc["service_code"] not in self.model_mapping:
+                result["labels"] = ("ERROR",)
+                result["error_message"] = "no CCAM model for service {}".format(
+                    doc["service_code"]
+                )
+                continue
+            result["service"] = str(doc["service_code"])
+            result["tokens"] = [int(i) for i in doc["tokens"]["input_ids"]]
+
+        return results
+
+    def _service_hint(self, meta):
+        """Return service id passed with the job if there is a model for it.
+
+        The service predicted by a routing worker takes precedence over the
+        hint of the client."""
+
+        service_id = meta.get("routed_service", meta.get("service"))
+        if service_id is None:
+            return None
+        if service_id not in self.model_mapping:
+            logger.warning("ignoring unknown service id %s", service_id)
+            return None
+        return service_id
+
 
 class CCAMSingleModelClassifier(BertCCAMClassifier):
     """Predict CCAM from a unique model for all services."""
 
     BATCH_SIZE = 16
+    USES_META = False
 
     def load_model(self, model_dir):
 
@@ -226,9 +539,12 @@ class CCAMSingleModelClassifier(BertCCAMClassifier):
         self._load_ccam_model(model_dir)
         self.MAX_LENGTH = self.ccam_model.config.max_position_embeddings - 2
 
-    def predict(self, documents):
+    def preprocess(self, documents, metas=None):
+
+        return self._tokenize(documents)
+
+    def predict_preprocessed(self, tokenized_docs):
 
-        tokenized_docs = self._tokenize(documents)
         ccam_codes = self._predict_ccam(tokenized_docs)
 
         return [{"labels": codes} for codes in ccam_codes]
@@ -238,12 +554,35 @@ class CRHSeverityClassifier:
     """Predict GHM severity level from 'compte rendu hospitalisation' (CRH)"""
 
     MAX_SENTENCES = 512
+    # number of sentences embedded together (from all documents of a batch)
+    SENTENCE_BATCH_SIZE = 64
+    # number of documents classified together by the sentence model
+    BATCH_SIZE = 16
+
+    def __init__(self, embedding_cache_size=None, shared_embedding_cache=False):
+        """Create classifier.
+
+        embedding_cache_size: number of sentence embeddings kept in memory
+            (None to disable the cache)
+        shared_embedding_cache: share the cached embeddings with other workers
+            through redis"""
+
+        self.embedding_cache_size = embedding_cache_size
+        self.shared_embedding_cache = shared_embedding_cache
+        self.embedding_cache = None
 
     def load_model(self, model_path):
         """Load all required models.
         
         model_path: path to model directory"""
 
+        if self.embedding_cache_size:
+            self.embedding_cache = EmbeddingCache(
+                self.embedding_cache_size,
+                model_version(model_path),
+                shared=self.shared_embedding_cache,
+            )
+
         self.sentence_tokenizer = joblib.load(
             os.path.join(model_path, "sentence_tokenizer.joblib")
         )
@@ -261,18 +600,180 @@ class CRHSeverityClassifier:
             # SavedModel (TF) format
             self.sentence_model = tf.keras.models.load_model(model_path)
 
+    def _split_sentences(self, documents):
+        "Return the lowercased sentences of each document (at most MAX_SENTENCES)."
+
+        sentences = []
+        for doc in documents:
+            doc_sentences = self.sentence_tokenizer.tokenize(doc)[: self.MAX_SENTENCES]
+            # empty documents are represented by a single empty sentence
+            sentences.append([s.lower() for s in doc_sentences] or [""])
+
+        return sentences
+
+    def _embedding_function(self):
+        "Return the sentence embedding function traced for all input shapes."
+
+        embedding_function = getattr(self, "_sentence_embedding_function", None)
+        if embedding_function is None:
+            embedding_model = self.sentence_embedding_model
+
+            @tf.function(
+                input_signature=[
+                    {"input_ids": TOKENS_SPEC, "attention_mask": TOKENS_SPEC}
+                ]
+            )
+            def embedding_function(inputs):
+                return embedding_model(inputs, training=False)
+
+            self._sentence_embedding_function = embedding_function
+
+        return embedding_function
+
+    def _embed_sentences(self, sentences):
+        """Embed a flat list of sentences.
+
+        Repeated sentences are embedded once, and the embeddings found in the
+        cache are not computed again. Returns an array of shape
+        (n_sentences, hidden_size)."""
+
+        cache = self.embedding_cache
+        keys = [cache.key(s) for s in sentences] if cache else sentences
+        texts = OrderedDict()
+        for key, sentence in zip(keys, sentences):
+            texts.setdefault(key, sentence)
+
+        embeddings = {}
+        unique_keys = list(texts)
+        if cache:
+            for key, value in zip(unique_keys, cache.get_many(unique_keys)):
+                if value is not None:
+                    embeddings[key] = value
+
+        missing = [key for key in unique_keys if key not in embeddings]
+        if missing:
+            computed = self._compute_embeddings([texts[key] for key in missing])
+            embeddings.update(zip(missing, computed))
+            if cache:
+                cache.set_many(missing, [value.copy() for value in computed])
+
+        if cache:
+            logger.debug("sentence embedding cache: %s", cache.stats())
+
+        return np.array([embeddings[key] for key in keys])
+
+    def _compute_embeddings(self, sentences):
+        """Run the sentence embedding model on a flat list of sentences.
+
+        The sentences are sorted by length and embedded in chunks of
+        SENTENCE_BATCH_SIZE padded to their longest sentence. Returns an array
+        of shape (n_sentences, hidden_size) in the original order."""
+
+        input_ids = self.word_tokenizer.batch_encode_plus(
+            sentences,
+            add_special_tokens=True,
+            max_length=self.sentence_embedding_model.config.max_position_embeddings,
+            pad_to_max_length=False,
+        )["input_ids"]
+
+        embedding_function = self._embedding_function()
+        embeddings = np.zeros(
+            (len(sentences), self.sentence_embedding_model.config.hidden_size),
+            dtype=np.float32,
+        )
+        order = sorted(range(len(input_ids)), key=lambda i: len(input_ids[i]))
+
+        for start in range(0, len(order), self.SENTENCE_BATCH_SIZE):
+            indices = order[start : start + self.SENTENCE_BATCH_SIZE]
+            length = max(len(input_ids[i]) for i in indices)
+            ids = np.full(
+                (len(indices), length), self.word_tokenizer.pad_token_id, dtype=np.int32
+            )
+            mask = np.zeros((len(indices), length), dtype=np.int32)
+            for row, i in enumerate(indices):
+                ids[row, : len(input_ids[i])] = input_ids[i]
+                mask[row, : len(input_ids[i])] = 1
+            output = embedding_function({"input_ids": ids, "attention_mask": mask})
+            embeddings[indices] = output.numpy()
+
+        return embeddings
+
+    def _make_batches(self, embeddings):
+        """Split a list of document embeddings into batches of the sentence model.
+
+        The documents are sorted by their number of sentences, so that each
+        batch is padded only to its longest document. Yields tuples of the
+        indices of the docs in the batch and the padded inputs."""
+
+        order = sorted(range(len(embeddings)), key=lambda i: len(embeddings[i]))
+
+        for start in range(0, len(order), self.BATCH_SIZE):
+            indices = order[start : start + self.BATCH_SIZE]
+            length = max(len(embeddings[i]) for i in indices)
+            hidden_size = embeddings[indices[0]].shape[1]
+            inputs_embeds = np.zeros(
+                (len(indices), length, hidden_size), dtype=np.float32
+            )
+            attention_mask = np.zeros((len(indices), length), dtype=np.int32)
+            for row, i in enumerate(indices):
+                inputs_embeds[row, : len(embeddings[i])] = embeddings[i]
+                attention_mask[row, : len(embeddings[i])] = 1
+            yield indices, {
+                "inputs_embeds": inputs_embeds,
+                "attention_mask": attention_mask,
+            }
+
+    def _serving_function(self):
+        "Return the prediction function of the sentence model traced for all input shapes."
+
+        serving_function = getattr(self, "_sentence_model_function", None)
+        if serving_function is None:
+            hidden_size = self.sentence_embedding_model.config.hidden_size
+            sentence_model = self.sentence_model
+
+            @tf.function(
+                input_signature=[
+                    {
+                        "inputs_embeds": tf.TensorSpec(
+                            [None, None, hidden_size], tf.float32
+                        ),
+                        "attention_mask": tf.TensorSpec([None, None], tf.int32),
+                    }
+                ]
+            )
+            def serving_function(inputs):
+                return sentence_model(inputs, training=False)
+
+            self._sentence_model_function = serving_function
+
+        return serving_function
+
+    def warmup(self):
+        "Run a synthetic document through the models."
+
+        self.predict(["Warmup. " * 10])
+
     def predict(self, documents):
-        """Predict severity level from raw text documents."""
-
-        dataset = create_sentence_dataset(
-            documents,
-            self.sentence_tokenizer,
-            self.word_tokenizer,
-            self.sentence_embedding_model,
-            max_sentences=self.MAX_SENTENCES,
+        """Predict severity level from raw text documents.
+
+        The sentences of all documents are embedded together, then the
+        documents are classified in batches padded to the longest document."""
+
+        sentences = self._split_sentences(documents)
+        flat_embeddings = self._embed_sentences(
+            [sentence for doc_sentences in sentences for sentence in doc_sentences]
         )
 
-        output = self.sentence_model.predict(dataset.batch(1))
+        # split the embeddings back into documents
+        boundaries = np.cumsum([len(doc_sentences) for doc_sentences in sentences])
+        embeddings = np.split(flat_embeddings, boundaries[:-1])
+
+        serving_function = self._serving_function()
+        output = [None] * len(documents)
+        for indices, inputs in self._make_batches(embeddings):
+            for i, doc_output in zip(indices, serving_function(inputs).numpy()):
+                output[i] = doc_output
+        output = np.array(output)
         severity_levels = output.argmax(1) + 1
 
         logger.debug("CRH prediction results: %s", output)
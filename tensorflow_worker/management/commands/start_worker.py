@@ -1,6 +1,15 @@
-from django.core.management.base import BaseCommand
-from tensorflow_worker.workers import RedisWorker
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from tensorflow_worker.workers import (
+    AdaptiveBatchPolicy,
+    MultiTaskWorker,
+    RedisWorker,
+    RoutingWorker,
+    WorkerPool,
+)
 from tensorflow_worker import classifiers
+from tensorflow_worker.caches import model_version
+import inspect
 import logging
 
 logger = logging.getLogger(__name__)
@@ -9,27 +18,218 @@ class Command(BaseCommand):
     help = "Start surgery procedures classifification worker"
 
     def add_arguments(self, parser):
-        parser.add_argument("classifier_class_name")
-        parser.add_argument("model_dir")
+        parser.add_argument("classifier_class_name", nargs="?")
+        parser.add_argument("model_dir", nargs="?")
+        parser.add_argument(
+            "--task",
+            nargs=3,
+            action="append",
+            default=[],
+            metavar=("CLASSIFIER", "MODEL_DIR", "QUEUE"),
+            help="serve another classifier from the same process (repeatable), "
+            "the batches are taken from the task with the most jobs waiting",
+        )
         parser.add_argument("--loglevel", type=str, default="INFO")
         parser.add_argument("--timeout", type=int, default=100)
         parser.add_argument("--queue", type=str, default=None)
+        parser.add_argument("--max-batch-size", type=int, default=16)
+        parser.add_argument(
+            "--latency-slo",
+            type=int,
+            default=None,
+            help="adapt batch size and timeout to reach this p95 batch latency (in ms)",
+        )
+        parser.add_argument(
+            "--result-ttl",
+            type=int,
+            default=None,
+            help="expiry of results in seconds (0 to disable)",
+        )
+        parser.add_argument(
+            "--ccam-cache-mb",
+            type=float,
+            default=None,
+            help="memory budget of the CCAM models kept in memory (BertCCAMClassifier)",
+        )
+        parser.add_argument(
+            "--preload",
+            action="store_true",
+            help="load all CCAM models at startup (BertCCAMClassifier)",
+        )
+        parser.add_argument(
+            "--embedding-cache-size",
+            type=int,
+            default=None,
+            help="number of sentence embeddings kept in memory (CRHSeverityClassifier)",
+        )
+        parser.add_argument(
+            "--shared-embedding-cache",
+            action="store_true",
+            help="share the sentence embeddings with other workers in redis "
+            "(CRHSeverityClassifier)",
+        )
+        parser.add_argument(
+            "--route",
+            action="store_true",
+            help="only predict the services and forward the documents to the "
+            "service queues (BertCCAMClassifier)",
+        )
+        parser.add_argument(
+            "--services",
+            nargs="+",
+            default=None,
+            help="process the documents routed to these services, keeping their "
+            "CCAM models in memory (BertCCAMClassifier)",
+        )
+        parser.add_argument(
+            "--bulk-share",
+            type=float,
+            default=0,
+            help="share of the batches serving the asynchronous (bulk) jobs "
+            "first, between 0 and 1 (by default the synchronous jobs always "
+            "come first)",
+        )
+        parser.add_argument(
+            "--pipeline",
+            action="store_true",
+            help="overlap dequeueing, preprocessing, prediction and publishing",
+        )
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=1,
+            help="number of worker processes, each one loads its own copy of "
+            "the models",
+        )
+
+    def load_classifier(self, classifier_class_name, model_dir, options):
+        "Load and warm up a classifier, return it with the version of its model."
+
+        Classifier = getattr(classifiers, classifier_class_name)
+        classifier_options = {}
+        if options["ccam_cache_mb"] is not None:
+            classifier_options["ccam_cache_mb"] = options["ccam_cache_mb"]
+        if options["preload"]:
+            classifier_options["preload"] = True
+        if options["services"]:
+            classifier_options["services"] = options["services"]
+        if options["embedding_cache_size"] is not None:
+            classifier_options["embedding_cache_size"] = options["embedding_cache_size"]
+        if options["shared_embedding_cache"]:
+            classifier_options["shared_embedding_cache"] = True
+        # the options of the other classifiers of a multi-task worker are ignored
+        parameters = inspect.signature(Classifier).parameters
+        classifier_options = {
+            name: value
+            for name, value in classifier_options.items()
+            if name in parameters
+        }
+
+        classifier = Classifier(**classifier_options)
+        classifier.load_model(model_dir)
+        version = model_version(model_dir)
+        logger.info("Model %s loaded (version %s).", classifier_class_name, version)
+
+        # the worker signals that it is ready only after the warmup
+        if hasattr(classifier, "warmup"):
+            classifier.warmup()
+            logger.info("Model %s warmed up.", classifier_class_name)
+        return classifier, version
 
     def handle(self, *args, **options):
         "Run command"
 
         loglevel = options["loglevel"]
-        classifier_class_name = options['classifier_class_name']
         timeout = options['timeout']
-        model_dir = options['model_dir']
-        queue = options["queue"]
+        result_ttl = options["result_ttl"]
+        processes = options["processes"]
+        pipeline = options["pipeline"]
+        max_batch_size = options["max_batch_size"]
+        latency_slo = options["latency_slo"]
         logger.info("Starting worker.")
 
-        Classifier = getattr(classifiers, classifier_class_name)
+        # (classifier class name, model directory, queue) of each task
+        tasks = []
+        if options["classifier_class_name"]:
+            if not options["model_dir"]:
+                raise CommandError("the model directory is missing")
+            tasks.append(
+                (options["classifier_class_name"], options["model_dir"], options["queue"])
+            )
+        tasks.extend(options["task"])
+        if not tasks:
+            raise CommandError("no classifier to serve")
+        route = options["route"]
+        if len(tasks) > 1 and (route or options["services"] or pipeline):
+            raise CommandError(
+                "--route, --services and --pipeline serve a single task"
+            )
+        if route and options["services"]:
+            raise CommandError("--route and --services are exclusive")
+        if not 0 <= options["bulk_share"] <= 1:
+            raise CommandError("--bulk-share must be between 0 and 1")
+        if route and not hasattr(getattr(classifiers, tasks[0][0]), "route"):
+            raise CommandError("{} can not route documents".format(tasks[0][0]))
 
-        classifier = Classifier()
-        classifier.load_model(model_dir)
-        logger.info("Model loaded.")
-        worker = RedisWorker(timeout=timeout, queue=queue)
+        def load_classifiers():
+            # all models stay in memory
+            return [
+                self.load_classifier(classifier_class_name, model_dir, options)
+                for classifier_class_name, model_dir, _ in tasks
+            ]
+
+        def create_worker(classifier, version, queue):
+            policy = None
+            if latency_slo:
+                policy = AdaptiveBatchPolicy(
+                    latency_slo, max_batch_size=max_batch_size, max_window=timeout
+                )
+            Worker = RoutingWorker if route else RedisWorker
+            return Worker(
+                max_batch_size=max_batch_size,
+                timeout=timeout,
+                queue=queue,
+                result_ttl=result_ttl,
+                policy=policy,
+                pass_meta=getattr(classifier, "USES_META", False),
+                model_version=version,
+                services=options["services"],
+                bulk_share=options["bulk_share"],
+            )
+
+        def run_worker():
+            loaded = load_classifiers()
+            if len(tasks) > 1:
+                MultiTaskWorker(
+                    [
+                        (create_worker(classifier, version, queue), classifier.predict)
+                        for (classifier, version), (_, _, queue) in zip(loaded, tasks)
+                    ]
+                ).run_loop()
+                return
+
+            (classifier, version), (_, _, queue) = loaded[0], tasks[0]
+            worker = create_worker(classifier, version, queue)
+            if route:
+                predict = classifier.route
+                if pipeline:
+                    worker.run_pipeline(predict)
+                else:
+                    worker.run_loop(predict)
+            elif not pipeline:
+                worker.run_loop(classifier.predict)
+            elif hasattr(classifier, "preprocess"):
+                worker.run_pipeline(
+                    classifier.predict_preprocessed, classifier.preprocess
+                )
+            else:
+                worker.run_pipeline(classifier.predict)
 
-        worker.run_loop(classifier.predict)
+        if processes > 1:
+            # forked processes must open their own database connections, and
+            # load their models: the thread pools of the TensorFlow runtime do
+            # not survive a fork
+            connections.close_all()
+            WorkerPool(processes, run_worker).run()
+        else:
+            run_worker()
@@ -0,0 +1,111 @@
+import os
+import tempfile
+import time
+
+import numpy as np
+import redis
+
+from django.conf import settings
+from django.test import TestCase, tag
+from tensorflow_worker.caches import EmbeddingCache, model_version
+
+
+@tag("worker")
+class TestEmbeddingCache(TestCase):
+    """Test the cache of sentence embeddings."""
+
+    def test_lru(self):
+        "Test evicting the least recently used embeddings."
+
+        cache = EmbeddingCache(2, "v1")
+        keys = [cache.key(text) for text in ["a", "b", "c"]]
+        values = [np.full(3, i, dtype=np.float32) for i in range(3)]
+
+        cache.set_many(keys[:2], values[:2])
+        # "a" is used more recently than "b"
+        cache.get_many(keys[:1])
+        cache.set_many(keys[2:], values[2:])
+
+        found = cache.get_many(keys)
+        np.testing.assert_array_equal(found[0], values[0])
+        self.assertIsNone(found[1])
+        np.testing.assert_array_equal(found[2], values[2])
+
+        self.assertEqual(cache.stats()["entries"], 2)
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+        self.assertEqual(cache.hit_rate, 0.75)
+
+    def test_key(self):
+        "Test if the keys depend on the normalized text and the model version."
+
+        cache = EmbeddingCache(2, "v1")
+        self.assertEqual(cache.key("Signed,\n Dr  X."), cache.key("signed, dr x."))
+        self.assertNotEqual(cache.key("dr x."), cache.key("dr y."))
+        self.assertNotEqual(cache.key("dr x."), EmbeddingCache(2, "v2").key("dr x."))
+
+    def test_model_version(self):
+        "Test if the model version changes with the model files."
+
+        with tempfile.TemporaryDirectory() as model_dir:
+            path = os.path.join(model_dir, "tf_model.h5")
+            with open(path, "w") as fid:
+                fid.write("weights")
+            version = model_version(model_dir)
+            self.assertEqual(model_version(model_dir), version)
+
+            with open(path, "w") as fid:
+                fid.write("new weights")
+            os.utime(path, (time.time() + 10, time.time() + 10))
+            self.assertNotEqual(model_version(model_dir), version)
+
+    def test_nested_model_version(self):
+        "Test if the model version changes with the files of the subdirectories."
+
+        with tempfile.TemporaryDirectory() as model_dir:
+            os.makedirs(os.path.join(model_dir, "ccam", "variables"))
+            path = os.path.join(model_dir, "ccam", "variables", "tf_model.h5")
+            with open(path, "w") as fid:
+                fid.write("weights")
+            version = model_version(model_dir)
+
+            # same size, the modification time changes
+            with open(path, "w") as fid:
+                fid.write("WEIGHTS")
+            os.utime(path, (time.time() + 10, time.time() + 10))
+            self.assertNotEqual(model_version(model_dir), version)
+
+
+@tag("worker", "redis")
+class TestSharedEmbeddingCache(TestCase):
+    """Test sharing the embeddings through redis.
+
+    These tests need running redis server."""
+
+    def setUp(self):
+        super().setUp()
+        self.db = redis.Redis(settings.REDIS_HOST)
+        self.db.flushdb()
+
+    def tearDown(self):
+        super().tearDown()
+        self.db.flushdb()
+
+    def test_shared(self):
+        "Test reusing embeddings computed by another worker."
+
+        value = np.arange(4, dtype=np.float32)
+        cache = EmbeddingCache(10, "v1", shared=True, ttl=60)
+        key = cache.key("hello")
+        cache.set_many([key], [value])
+
+        self.assertGreater(self.db.ttl(settings.REDIS_EMBEDDING_PREFIX + key), 0)
+
+        other = EmbeddingCache(10, "v1", shared=True)
+        found = other.get_many([key, other.key("world")])
+        np.testing.assert_array_equal(found[0], value)
+        self.assertIsNone(found[1])
+        self.assertEqual(other.shared_hits, 1)
+
+        # now in memory
+        other.get_many([key])
+        self.assertEqual((other.hits, other.shared_hits, other.misses), (2, 1, 1))
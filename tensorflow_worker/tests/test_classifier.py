@@ -1,4 +1,9 @@
-from unittest import TestCase
+import json
+import os
+import tempfile
+from unittest import TestCase, mock
+
+import numpy as np
 from tensorflow_worker.classifiers import (
     BertCCAMClassifier,
     CRHSeverityClassifier,
@@ -40,6 +45,126 @@ class DummyClassifierTest(TestCase):
         prediction = classifier.predict(["bert", "bartosz"])
         self.assertEqual(prediction, [{"labels": ("C",)}, {"labels": ("B",)}])
 
+    def test_ccam_model_cache(self):
+        "Test keeping the CCAM models of several services in memory."
+
+        classifier = BertCCAMClassifier()
+        classifier.load_model("models")
+        self.assertEqual(len(classifier._ccam_models), 0)
+
+        prediction = classifier.predict(["bartosz", "bert"])
+        self.assertEqual(prediction, [{"labels": ("B",)}, {"labels": ("C",)}])
+        self.assertEqual(len(classifier._ccam_models), 2)
+
+        # budget smaller than a single model
+        classifier = BertCCAMClassifier(ccam_cache_mb=1e-6)
+        classifier.load_model("models")
+        prediction = classifier.predict(["bartosz", "bert"])
+        self.assertEqual(prediction, [{"labels": ("B",)}, {"labels": ("C",)}])
+        self.assertEqual(len(classifier._ccam_models), 1)
+
+    def test_preload_ccam_models(self):
+        "Test loading all CCAM models at startup."
+
+        classifier = BertCCAMClassifier(preload=True)
+        classifier.load_model("models")
+        self.assertEqual(
+            set(classifier._ccam_models), set(classifier.model_mapping.values())
+        )
+
+    def test_shared_encoder(self):
+        "Test running the encoder once for the service and CCAM heads."
+
+        with open("models/model_mapping.json") as fid:
+            mapping = json.load(fid)
+        models_dir = os.path.abspath("models")
+        for conf in [mapping["tokenizer"], mapping["service_model"]] + mapping["ccam_models"]:
+            conf["path"] = os.path.join(models_dir, conf["path"])
+            conf["shared_encoder"] = True
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with open(os.path.join(tmp_dir, "model_mapping.json"), "w") as fid:
+                json.dump(mapping, fid)
+            classifier = BertCCAMClassifier()
+            classifier.load_model(tmp_dir)
+
+        self.assertEqual(classifier.shared_encoder_services, {"1", "2", "3"})
+
+        # the service head on the encoder output is the full service model
+        tokens = classifier._tokenize(["bartosz", "bert", "ala bert"])
+        self.assertEqual(
+            list(classifier._predict_service_head(classifier._encode(tokens))),
+            list(classifier._predict_service(tokens)),
+        )
+
+        prediction = classifier.predict(["bartosz", "bert"])
+        self.assertEqual(len(prediction), 2)
+        self.assertTrue(all("labels" in p for p in prediction))
+
+        # the CCAM head on the encoder output is the full CCAM model when the
+        # encoder is really shared
+        ccam_model, _ = classifier._get_ccam_model(classifier.model_mapping["1"])
+        ccam_model.roberta.set_weights(classifier.service_model.roberta.get_weights())
+        features = classifier._encode(tokens)
+        np.testing.assert_allclose(
+            ccam_model.classifier(features[:, None, :], training=False).numpy(),
+            classifier._run_model(ccam_model, tokens),
+            rtol=1e-5,
+            atol=1e-6,
+        )
+        self.assertEqual(
+            [list(codes) for codes in classifier._predict_ccam_head(features, "1")],
+            [list(codes) for codes in classifier._predict_ccam_for_service(tokens, "1")],
+        )
+
+    def test_service_hint(self):
+        "Test skipping the service model for documents with a service id."
+
+        classifier = BertCCAMClassifier()
+        classifier.load_model("models")
+
+        with mock.patch.object(
+            classifier, "_predict_service", wraps=classifier._predict_service
+        ) as predict_service:
+            prediction = classifier.predict(
+                ["bartosz", "bert"], metas=[{"service": "1"}, {}]
+            )
+            self.assertEqual(prediction, [{"labels": ("B",)}, {"labels": ("C",)}])
+            # only the document without hint went through the service model
+            self.assertEqual(len(predict_service.call_args[0][0]), 1)
+
+            predict_service.reset_mock()
+            prediction = classifier.predict(["bert"], metas=[{"service": "2"}])
+            self.assertEqual(prediction, [{"labels": ("C",)}])
+            predict_service.assert_not_called()
+
+    def test_route(self):
+        "Test predicting only the services of documents for the service queues."
+
+        classifier = BertCCAMClassifier()
+        classifier.load_model("models")
+        routes = classifier.route(["bartosz", "bert"], metas=[{}, {"service": "1"}])
+        self.assertIn(routes[0]["service"], classifier.model_mapping)
+        self.assertEqual(routes[1]["service"], "1")
+        self.assertTrue(all(isinstance(i, int) for i in routes[0]["tokens"]))
+
+        # the routed tokens give the same prediction as the text
+        meta = {"routed_service": routes[0]["service"], "tokens": routes[0]["tokens"]}
+        prediction = classifier.predict(["ignored"], metas=[meta])
+        self.assertEqual(prediction, classifier.predict(["bartosz"]))
+
+    def test_services(self):
+        "Test loading the CCAM models of the services of the worker."
+
+        classifier = BertCCAMClassifier(services=["2"])
+        classifier.load_model("models")
+        self.assertEqual(
+            list(classifier._ccam_models), [classifier.model_mapping["2"]]
+        )
+
+        with self.assertRaises(ValueError):
+            BertCCAMClassifier(services=["99"]).load_model("models")
+
     def test_validate_input_data(self):
         "Test validation of classifier inputs."
 
@@ -55,6 +180,29 @@ class DummyClassifierTest(TestCase):
             ],
         )
 
+    def test_preprocess(self):
+        "Test running preprocessing and prediction separately."
+
+        classifier = BertCCAMClassifier()
+        classifier.load_model("models")
+        preprocessed = classifier.preprocess(["bartosz", 5])
+        prediction = classifier.predict_preprocessed(preprocessed)
+
+        self.assertEqual(
+            prediction,
+            [
+                {"labels": ("B",)},
+                {"labels": ("ERROR",), "error_message": "wrong document format"},
+            ],
+        )
+
+        # no valid documents
+        prediction = classifier.predict([5])
+        self.assertEqual(
+            prediction,
+            [{"labels": ("ERROR",), "error_message": "wrong document format"}],
+        )
+
     def test_large_batch(self):
         """Test if classifier can handle large data batches."""
 
@@ -63,6 +211,63 @@ class DummyClassifierTest(TestCase):
         prediction = classifier.predict(["bert", "bartosz"] * 101)
         self.assertEqual(prediction, [{"labels": ("C",)}, {"labels": ("B",)}] * 101)
 
+    def test_length_buckets(self):
+        "Test padding the batches to the length of their longest document."
+
+        classifier = BertCCAMClassifier()
+        classifier.load_model("models")
+        classifier.BATCH_SIZE = 2
+        classifier.BUCKET_LENGTHS = (4, 8)
+
+        texts = ["bartosz " * 10, "ada", "bert bert", "ada"]
+        tokens = classifier._tokenize(texts)
+        batches = list(classifier._make_batches(tokens))
+
+        # short documents are batched together
+        self.assertEqual([sorted(indices) for indices, _ in batches], [[1, 3], [0, 2]])
+        self.assertLessEqual(batches[0][1]["input_ids"].shape[1], 8)
+        self.assertEqual(batches[1][1]["input_ids"].shape[1], classifier.MAX_LENGTH)
+
+        # results in the original order
+        prediction = classifier.predict(["bartosz " * 10, "bert", "bartosz", "bert"])
+        self.assertEqual(
+            prediction,
+            [{"labels": ("B",)}, {"labels": ("C",)}, {"labels": ("B",)}, {"labels": ("C",)}],
+        )
+
+    def test_serving_function(self):
+        "Test if the serving function is traced once and reused for all shapes."
+
+        classifier = BertCCAMClassifier()
+        classifier.load_model("models")
+        serving_function = classifier._serving_function(classifier.service_model)
+        self.assertIs(
+            classifier._serving_function(classifier.service_model), serving_function
+        )
+
+        # the model is called (in Python) only when the function is traced
+        call = classifier.service_model.call
+        traces = []
+
+        def traced_call(*args, **kwargs):
+            traces.append(args)
+            return call(*args, **kwargs)
+
+        with mock.patch.object(classifier.service_model, "call", traced_call):
+            classifier.predict(["bert"])
+            n_traces = len(traces)
+            self.assertGreater(n_traces, 0)
+
+            # other batch sizes and bucket lengths
+            prediction = classifier.predict(["bartosz", "bartosz " * 10, "bert"])
+            classifier.predict(["bert"] * (classifier.BATCH_SIZE + 1))
+            self.assertEqual(len(traces), n_traces)
+
+        self.assertEqual(
+            prediction, [{"labels": ("B",)}, {"labels": ("B",)}, {"labels": ("C",)}]
+        )
+        self.assertIs(classifier.service_model._serving_function, serving_function)
+
     def test_very_long_text(self):
         "Test if the classifier accepts texts longer than its inputs."
 
@@ -98,6 +303,33 @@ class CRHSeverityClassifierTests(TestCase):
         prediction = classifier.predict(["bert", "bartosz"] * 101)
         self.assertEqual(prediction, [{"labels": ["3"]}, {"labels": ["2"]}] * 101)
 
+    def test_cross_document_batches(self):
+        "Test if batching documents of different lengths does not change predictions."
+
+        classifier = CRHSeverityClassifier()
+        classifier.load_model("models/crh_severity_model")
+        classifier.SENTENCE_BATCH_SIZE = 3
+        classifier.BATCH_SIZE = 2
+
+        documents = ["Bartosz. Ada.", "bert", "Ada. " * 7, "", "Bert ala. Bert ala."]
+        expected = [classifier.predict([doc])[0] for doc in documents]
+        self.assertEqual(classifier.predict(documents), expected)
+
+    def test_embedding_cache(self):
+        "Test reusing the embeddings of repeated sentences."
+
+        classifier = CRHSeverityClassifier(embedding_cache_size=100)
+        classifier.load_model("models/crh_severity_model")
+
+        prediction = classifier.predict(["Bartosz. Ada. Bartosz."])
+        self.assertEqual(prediction, [{"labels": ["1"]}])
+        # the repeated sentence is embedded once
+        self.assertEqual(classifier.embedding_cache.misses, 2)
+
+        prediction = classifier.predict(["Bartosz. Ada."])
+        self.assertEqual(prediction, [{"labels": ["1"]}])
+        self.assertEqual(classifier.embedding_cache.hits, 2)
+
     def test_very_long_text(self):
         "Test if the classifier accepts texts longer than its inputs."
 
@@ -1,4 +1,6 @@
 import json
+import os
+import signal
 import threading
 import time
 from unittest import skipIf
@@ -8,10 +10,21 @@ import redis
 
 from django.conf import settings
 from django.test import TestCase, tag
+from predict.cache import InflightRegistry, ResultCache
+from predict.messages import MAGIC, decode, encode
 from predict.models import Prediction
+from predict.views import RedisClient
 
 try:
-    from tensorflow_worker.workers import RedisWorker
+    from tensorflow_worker.workers import (
+        AdaptiveBatchPolicy,
+        MultiTaskWorker,
+        RedisWorker,
+        RoutingWorker,
+        WorkerPool,
+        service_queue,
+    )
+    from predict.queues import bulk_queue, tenants_key
 except ModuleNotFoundError:
     RedisWorker = None
 
@@ -108,6 +121,718 @@ class TestRedisWorker(TestCase):
         self.assertEqual(json.loads(self.db.get("2")), {"labels": ["CCC001"], "status": "done"})
         predict.assert_called_once_with(["my text 2"])
 
+    def test_worker_reply(self):
+        "Test sending the results of a batch to the reply lists of the requests."
+
+        for doc_id, reply_key in [("1", "reply:a"), ("2", "reply:b"), ("3", "reply:a")]:
+            self.db.rpush(
+                self.QUEUE,
+                json.dumps(
+                    {"id": doc_id, "text": "text " + doc_id, "reply_to": reply_key}
+                ),
+            )
+
+        worker = RedisWorker(queue=self.QUEUE, result_ttl=60)
+        predict = Mock(return_value=[{"labels": [label]} for label in "ABC"])
+        worker.run_loop_once(predict)
+
+        self.assertEqual(self.db.llen("reply:a"), 1)
+        _, data = self.db.blpop("reply:a", timeout=1)
+        self.assertEqual(
+            json.loads(data),
+            [
+                {"id": "1", "labels": ["A"], "status": "done"},
+                {"id": "3", "labels": ["C"], "status": "done"},
+            ],
+        )
+        self.assertGreater(self.db.ttl("reply:b"), 0)
+        _, data = self.db.blpop("reply:b", timeout=1)
+        self.assertEqual(json.loads(data), [{"id": "2", "labels": ["B"], "status": "done"}])
+        self.assertIsNone(self.db.get("1"))
+
+    def test_drop_expired_jobs(self):
+        "Test if the jobs are dropped after their deadline."
+
+        now = time.time()
+        for doc_id, deadline in [("1", now - 1), ("2", now + 60), ("3", None)]:
+            self.db.rpush(
+                self.QUEUE,
+                json.dumps({"id": doc_id, "text": "text " + doc_id, "deadline": deadline}),
+            )
+
+        worker = RedisWorker(queue=self.QUEUE)
+        predict = Mock(return_value=[{"labels": ["A"]}, {"labels": ["B"]}])
+        with self.assertLogs("tensorflow_worker.workers", level="WARNING") as cm:
+            worker.run_loop_once(predict)
+            self.assertRegex(cm.output[0], "dropping 1 expired jobs")
+
+        predict.assert_called_once_with(["text 2", "text 3"])
+        self.assertIsNone(self.db.get("1"))
+
+        # all jobs expired
+        self.db.rpush(
+            self.QUEUE, json.dumps({"id": "4", "text": "text", "deadline": now - 1})
+        )
+        predict.reset_mock()
+        worker.run_loop_once(predict)
+        predict.assert_not_called()
+
+    def test_result_ttl(self):
+        "Test if results expire after the configured time."
+
+        self.job("1", "my text 1")
+        self.job("2", "my text 2")
+
+        worker = RedisWorker(queue=self.QUEUE, result_ttl=60)
+        predict = Mock(return_value=[{"labels": ["A"]}, {"labels": ["B"]}])
+        worker.run_loop_once(predict)
+
+        for doc_id in ["1", "2"]:
+            ttl = self.db.ttl(doc_id)
+            self.assertGreater(ttl, 0)
+            self.assertLessEqual(ttl, 60)
+
+        # results kept forever
+        self.job("3", "my text 3")
+        worker = RedisWorker(queue=self.QUEUE, result_ttl=0)
+        predict = Mock(return_value=[{"labels": ["C"]}])
+        worker.run_loop_once(predict)
+
+        self.assertEqual(json.loads(self.db.get("3")), {"labels": ["C"], "status": "done"})
+        self.assertEqual(self.db.ttl("3"), -1)
+
+    def test_worker_pass_meta(self):
+        "Test passing the job metadata to the classifier."
+
+        self.db.rpush(
+            self.QUEUE, json.dumps({"id": "1", "text": "text 1", "service": "7"})
+        )
+        self.job("2", "text 2")
+
+        worker = RedisWorker(queue=self.QUEUE, pass_meta=True)
+        predict = Mock(return_value=[{"labels": ["A"]}, {"labels": ["B"]}])
+        worker.run_loop_once(predict)
+
+        predict.assert_called_once_with(
+            ["text 1", "text 2"], metas=[{"service": "7"}, {}]
+        )
+
+    def test_worker_result_cache(self):
+        "Test if the worker stores its results in the cache of its model version."
+
+        self.job("1", "my  text")
+        self.job("2", "fail")
+
+        def predict(texts):
+            return [
+                {"labels": [], "error_message": "failed"}
+                if text == "fail"
+                else {"labels": ["A"]}
+                for text in texts
+            ]
+
+        worker = RedisWorker(queue=self.QUEUE, model_version="v1")
+        worker.run_loop_once(predict)
+
+        cache = ResultCache(self.db, self.QUEUE)
+        self.assertEqual(cache.get_version(), "v1")
+        # the errors are not cached
+        self.assertEqual(
+            cache.get_many("v1", [("my text", None), ("fail", None)]),
+            [{"labels": ["A"]}, None],
+        )
+        # other model version or service
+        self.assertEqual(cache.get_many("v2", [("my text", None)]), [None])
+        self.assertEqual(cache.get_many("v1", [("my text", "1")]), [None])
+
+    def test_result_cache_size(self):
+        "Test if the result cache keeps only the most recent results."
+
+        cache = ResultCache(self.db, self.QUEUE)
+        with self.settings(RESULT_CACHE_MAX_ENTRIES=2):
+            for text in ["a", "b", "c"]:
+                cache.set_many("v1", [(text, None, {"labels": [text]})])
+
+        self.assertEqual(
+            cache.get_many("v1", [("a", None), ("b", None), ("c", None)]),
+            [None, {"labels": ["b"]}, {"labels": ["c"]}],
+        )
+        self.assertEqual(self.db.zcard(cache.index_key), 2)
+
+    def test_identical_jobs_in_batch(self):
+        "Test if the identical documents of a batch are predicted once."
+
+        self.job("1", "my text")
+        self.job("2", "other text")
+        self.job("3", "my  text")
+
+        worker = RedisWorker(queue=self.QUEUE)
+        predict = Mock(return_value=[{"labels": ["A"]}, {"labels": ["B"]}])
+        worker.run_loop_once(predict)
+
+        predict.assert_called_once_with(["my text", "other text"])
+        self.assertEqual(
+            [json.loads(self.db.get(doc_id)) for doc_id in "123"],
+            [
+                {"labels": ["A"], "status": "done"},
+                {"labels": ["B"], "status": "done"},
+                {"labels": ["A"], "status": "done"},
+            ],
+        )
+
+    def test_single_flight(self):
+        "Test sending the result of a job to the identical jobs waiting for it."
+
+        registry = InflightRegistry(self.db, self.QUEUE)
+        key = registry.key("my text")
+        deadline = time.time() + 60
+        Prediction.objects.create(id="async", status="queued")
+        Prediction.objects.create(id="async-2", status="queued")
+
+        self.assertEqual(registry.register([key], ["leader"], deadline), [1])
+        waiters = [
+            {"id": "sync", "reply_to": "reply:b"},
+            {"id": "async", "persist": True, "duplicates": ["async-2"]},
+        ]
+        self.assertEqual(
+            registry.register([key], [json.dumps(waiters[0])], deadline - 1), [0]
+        )
+        # asynchronous jobs can not wait for jobs with a deadline
+        self.assertEqual(registry.register([key], [json.dumps(waiters[1])]), [-1])
+        # the waiters expire with the leader
+        self.assertGreater(self.db.pttl(registry.waiters_key(key)), 0)
+
+        self.db.rpush(
+            self.QUEUE,
+            json.dumps(
+                {
+                    "id": "leader",
+                    "text": "my text",
+                    "reply_to": "reply:a",
+                    "deadline": deadline,
+                    "inflight": key,
+                }
+            ),
+        )
+        worker = RedisWorker(queue=self.QUEUE)
+        worker.run_loop_once(Mock(return_value=[{"labels": ["A"]}]))
+
+        _, data = self.db.blpop("reply:a", timeout=1)
+        self.assertEqual(
+            json.loads(data), [{"id": "leader", "labels": ["A"], "status": "done"}]
+        )
+        _, data = self.db.blpop("reply:b", timeout=1)
+        self.assertEqual(
+            json.loads(data), [{"id": "sync", "labels": ["A"], "status": "done"}]
+        )
+        self.assertFalse(self.db.exists(key, registry.waiters_key(key)))
+
+        # asynchronous leader with waiters
+        self.assertEqual(registry.register([key], ["leader"]), [1])
+        self.assertEqual(registry.register([key], [json.dumps(waiters[1])]), [0])
+        self.db.rpush(
+            self.QUEUE,
+            json.dumps({"id": "leader", "text": "my text", "inflight": key}),
+        )
+        worker.run_loop_once(Mock(return_value=[{"labels": ["B"]}]))
+
+        for doc_id in ["async", "async-2"]:
+            instance = Prediction.objects.get(id=doc_id)
+            self.assertEqual(instance.status, "done")
+            self.assertEqual(instance.labels, ["B"])
+
+    def test_inflight_lease(self):
+        "Test that the waiters of a lost job are sent the results of the next job."
+
+        registry = InflightRegistry(self.db, self.QUEUE)
+        key = registry.key("my text")
+        Prediction.objects.create(id="async", status="queued")
+        waiter = json.dumps({"id": "async", "persist": True})
+
+        # the worker renews the lease of the jobs it holds
+        self.assertEqual(registry.register([key], ["leader"]), [1])
+        worker = RedisWorker(queue=self.QUEUE)
+        worker.unpack([json.dumps({"id": "leader", "text": "my text", "inflight": key})])
+        with self.settings(INFLIGHT_LEASE=60):
+            worker.heartbeat(force=True)
+        self.assertGreater(self.db.pttl(key), 1000)
+        worker.claim_waiters([key])
+        self.assertEqual(worker.leases, set())
+
+        # the job is lost
+        with self.settings(INFLIGHT_LEASE=0.2):
+            self.assertEqual(registry.register([key], ["leader"]), [1])
+        self.assertEqual(registry.register([key], [waiter]), [0])
+        time.sleep(0.3)
+        self.assertFalse(self.db.exists(key))
+        # a synchronous job would drop the waiters when it expires
+        self.assertEqual(registry.register([key], ["sync"], time.time() + 60), [-1])
+        self.assertEqual(registry.register([key], ["new leader"]), [1])
+
+        self.db.rpush(
+            self.QUEUE,
+            json.dumps({"id": "new leader", "text": "my text", "inflight": key}),
+        )
+        worker.run_loop_once(Mock(return_value=[{"labels": ["A"]}]))
+
+        instance = Prediction.objects.get(id="async")
+        self.assertEqual(instance.status, "done")
+        self.assertEqual(instance.labels, ["A"])
+
+    def test_binary_messages(self):
+        "Test if the worker accepts JSON and binary messages."
+
+        self.db.rpush(
+            self.QUEUE,
+            encode({"id": "1", "text": "text 1", "reply_to": "reply:a"}, "msgpack"),
+            encode({"id": "2", "text": "text 2", "reply_to": "reply:a"}, "json"),
+        )
+
+        worker = RedisWorker(queue=self.QUEUE)
+        predict = Mock(return_value=[{"labels": ["A"]}, {"labels": ["B"]}])
+        with self.settings(REDIS_MESSAGE_FORMAT="msgpack"):
+            worker.run_loop_once(predict)
+
+        predict.assert_called_once_with(["text 1", "text 2"])
+        _, data = self.db.blpop("reply:a", timeout=1)
+        self.assertTrue(data.startswith(MAGIC))
+        self.assertEqual(
+            decode(data),
+            [
+                {"id": "1", "labels": ["A"], "status": "done"},
+                {"id": "2", "labels": ["B"], "status": "done"},
+            ],
+        )
+
+    def test_job_envelopes(self):
+        "Test splitting the envelopes of jobs into batches."
+
+        jobs = [{"id": str(i), "text": "text {}".format(i)} for i in range(5)]
+        self.db.rpush(
+            self.QUEUE,
+            json.dumps({"jobs": jobs[:4], "reply_to": "reply:a"}),
+            json.dumps({**jobs[4], "reply_to": "reply:a"}),
+        )
+
+        worker = RedisWorker(queue=self.QUEUE, max_batch_size=3)
+        predict = Mock(side_effect=lambda texts: [{"labels": ["A"]} for _ in texts])
+        worker.run_loop_once(predict)
+        predict.assert_called_with(["text 0", "text 1", "text 2"])
+        # the rest of the envelope is left for the next batch
+        self.assertEqual(len(worker.buffer), 1)
+        self.assertEqual(self.db.llen(self.QUEUE), 1)
+
+        worker.run_loop_once(predict)
+        predict.assert_called_with(["text 3", "text 4"])
+        self.assertEqual(len(worker.buffer), 0)
+
+        replies = [json.loads(reply) for reply in self.db.lrange("reply:a", 0, -1)]
+        self.assertEqual(
+            [[result["id"] for result in reply] for reply in replies],
+            [["0", "1", "2"], ["3", "4"]],
+        )
+
+    def test_envelopes_fill_batch(self):
+        "Test if the envelopes are popped only until the batch is full."
+
+        self.job("single", "single text")
+        for i in range(10):
+            jobs = [{"id": f"{i}-{j}", "text": f"text {i}-{j}"} for j in range(4)]
+            self.db.rpush(self.QUEUE, json.dumps({"jobs": jobs}))
+
+        worker = RedisWorker(queue=self.QUEUE, max_batch_size=8)
+        predict = Mock(side_effect=lambda texts: [{"labels": ["A"]} for _ in texts])
+        worker.run_loop_once(predict)
+
+        self.assertEqual(len(predict.call_args[0][0]), 8)
+        # only the rest of the last envelope is left in the buffer
+        self.assertEqual(len(worker.buffer), 1)
+        self.assertEqual(self.db.llen(self.QUEUE), 8)
+        self.assertEqual(worker.jobs_per_message, 4)
+
+        # the envelopes that did not fit keep their order
+        worker.run_loop_once(predict)
+        texts = ["text 1-3"] + ["text 2-{}".format(j) for j in range(4)]
+        predict.assert_called_with(texts + ["text 3-{}".format(j) for j in range(3)])
+
+    def test_single_jobs_fill_batch(self):
+        "Test if a batch of single jobs is popped in a single round trip."
+
+        for i in range(10):
+            self.job(str(i), "text {}".format(i))
+
+        worker = RedisWorker(queue=self.QUEUE, max_batch_size=8)
+        worker._pop_batch_script = Mock(wraps=worker._pop_batch_script)
+        predict = Mock(side_effect=lambda texts: [{"labels": ["A"]} for _ in texts])
+        worker.run_loop_once(predict)
+
+        predict.assert_called_once_with(["text {}".format(i) for i in range(8)])
+        self.assertEqual(worker._pop_batch_script.call_count, 1)
+        self.assertEqual(self.db.llen(self.QUEUE), 2)
+
+    def test_priority_lanes(self):
+        "Test serving the synchronous jobs before the bulk jobs."
+
+        bulk = bulk_queue(self.QUEUE)
+        self.db.rpush(
+            bulk,
+            *[json.dumps({"id": str(i), "text": "bulk {}".format(i)}) for i in range(3)]
+        )
+        self.db.rpush(
+            self.QUEUE,
+            *[json.dumps({"id": str(i), "text": "sync {}".format(i)}) for i in range(3, 5)]
+        )
+
+        worker = RedisWorker(queue=self.QUEUE, max_batch_size=3)
+        predict = Mock(side_effect=lambda texts: [{"labels": ["A"]} for _ in texts])
+        worker.run_loop_once(predict)
+        # the batch is completed with the bulk jobs
+        predict.assert_called_with(["sync 3", "sync 4", "bulk 0"])
+        worker.run_loop_once(predict)
+        predict.assert_called_with(["bulk 1", "bulk 2"])
+
+    def test_bulk_share(self):
+        "Test serving the bulk jobs first for a share of the batches."
+
+        bulk = bulk_queue(self.QUEUE)
+        self.db.rpush(
+            bulk,
+            *[json.dumps({"id": str(i), "text": "bulk {}".format(i)}) for i in range(2)]
+        )
+        self.db.rpush(
+            self.QUEUE,
+            *[json.dumps({"id": str(i), "text": "sync {}".format(i)}) for i in range(2, 6)]
+        )
+
+        worker = RedisWorker(queue=self.QUEUE, max_batch_size=1, bulk_share=0.5)
+        predict = Mock(side_effect=lambda texts: [{"labels": ["A"]} for _ in texts])
+        for _ in range(4):
+            worker.run_loop_once(predict)
+        self.assertEqual(
+            [args[0] for args, _ in predict.call_args_list],
+            [["sync 2"], ["bulk 0"], ["sync 3"], ["bulk 1"]],
+        )
+
+    def push_tenant(self, tenant, texts):
+        "Push jobs to the sub-queue of a tenant as the API does."
+
+        messages = [json.dumps({"id": text, "text": text}) for text in texts]
+        RedisClient().push_tenant(self.QUEUE, tenant, messages)
+
+    def test_fair_scheduling(self):
+        "Test sharing the batches between the tenants."
+
+        self.push_tenant("a", ["a {}".format(i) for i in range(5)])
+        self.push_tenant("b", ["b 0", "b 1"])
+        # jobs pushed directly to the queue are served in order
+        self.job("c", "c 0")
+
+        worker = RedisWorker(queue=self.QUEUE, max_batch_size=4)
+        predict = Mock(side_effect=lambda texts: [{"labels": ["A"]} for _ in texts])
+        worker.run_loop_once(predict)
+        predict.assert_called_with(["a 0", "b 0", "a 1", "b 1"])
+        worker.run_loop_once(predict)
+        predict.assert_called_with(["a 2", "c 0", "a 3", "a 4"])
+
+        self.assertEqual(self.db.llen(self.QUEUE), 0)
+        self.assertFalse(self.db.exists(tenants_key(self.QUEUE)))
+
+    def test_returning_tenant(self):
+        "Test if the tenants that send new jobs join the back of the ring."
+
+        self.push_tenant("a", ["a {}".format(i) for i in range(4)])
+        self.push_tenant("b", ["b 0"])
+
+        worker = RedisWorker(queue=self.QUEUE, max_batch_size=2)
+        predict = Mock(side_effect=lambda texts: [{"labels": ["A"]} for _ in texts])
+        worker.run_loop_once(predict)
+        predict.assert_called_with(["a 0", "b 0"])
+
+        # b left the ring and comes back after c
+        self.push_tenant("c", ["c 0"])
+        self.push_tenant("b", ["b 1"])
+        worker = RedisWorker(queue=self.QUEUE, max_batch_size=3)
+        worker.run_loop_once(predict)
+        predict.assert_called_with(["a 1", "c 0", "b 1"])
+
+    def test_service_routing(self):
+        "Test routing the jobs to the workers of their service."
+
+        self.job("1", "text 1")
+        self.db.rpush(
+            self.QUEUE,
+            json.dumps({"id": "2", "text": "text 2", "reply_to": "reply:a"}),
+            json.dumps(
+                {"id": "3", "text": "text 3", "reply_to": "reply:a", "service": "7"}
+            ),
+        )
+
+        def route(texts, metas):
+            return [
+                {"service": "12", "tokens": [5, 6]},
+                {"labels": ["ERROR"], "error_message": "no CCAM model for service 8"},
+                {"service": metas[2]["service"], "tokens": [5, 7]},
+            ]
+
+        router = RoutingWorker(queue=self.QUEUE, pass_meta=True)
+        router.run_loop_once(route)
+        # the bulk jobs stay in the bulk lane of their service
+        self.db.rpush(
+            bulk_queue(self.QUEUE),
+            json.dumps({"id": "4", "text": "text 4", "persist": True, "service": "7"}),
+        )
+        router.run_loop_once(
+            lambda texts, metas: [{"service": "7", "tokens": [5, 8]}]
+        )
+        self.assertEqual(self.db.llen(bulk_queue(service_queue(self.QUEUE, "7"))), 1)
+
+        _, data = self.db.blpop("reply:a", timeout=1)
+        self.assertEqual(
+            json.loads(data),
+            [
+                {
+                    "id": "2",
+                    "labels": ["ERROR"],
+                    "error_message": "no CCAM model for service 8",
+                    "status": "error",
+                }
+            ],
+        )
+        self.assertEqual(self.db.llen(service_queue(self.QUEUE, "12")), 1)
+
+        # worker of services 7 and 12
+        worker = RedisWorker(queue=self.QUEUE, pass_meta=True, services=["7", "12"])
+        predict = Mock(
+            side_effect=lambda texts, metas: [{"labels": ["A"]} for _ in texts]
+        )
+        worker.run_loop_once(predict)
+        worker.run_loop_once(predict)
+
+        # one batch per service, completed with the bulk jobs of the service
+        batches = sorted(
+            (args[0], kwargs["metas"]) for args, kwargs in predict.call_args_list
+        )
+        self.assertEqual(
+            [texts for texts, _ in batches], [["text 1"], ["text 3", "text 4"]]
+        )
+        meta_1, meta_3 = batches[0][1][0], batches[1][1][0]
+        self.assertEqual((meta_1["routed_service"], meta_1["tokens"]), ("12", [5, 6]))
+        self.assertEqual((meta_3["routed_service"], meta_3["service"]), ("7", "7"))
+
+        self.assertEqual(
+            json.loads(self.db.get("1")), {"labels": ["A"], "status": "done"}
+        )
+        _, data = self.db.blpop("reply:a", timeout=1)
+        self.assertEqual(
+            json.loads(data), [{"id": "3", "labels": ["A"], "status": "done"}]
+        )
+
+    def test_routing_leases(self):
+        "Test if the workers of the services take over the leases of the routed jobs."
+
+        registry = InflightRegistry(self.db, self.QUEUE)
+        keys = [registry.key("text {}".format(i)) for i in range(5)]
+        self.assertEqual(registry.register(keys, []), [1] * 5)
+        self.db.rpush(
+            bulk_queue(self.QUEUE),
+            *[
+                json.dumps(
+                    {
+                        "id": str(i),
+                        "text": "text {}".format(i),
+                        "persist": True,
+                        "inflight": key,
+                    }
+                )
+                for i, key in enumerate(keys)
+            ]
+        )
+
+        router = RoutingWorker(queue=self.QUEUE, pass_meta=True)
+        router.run_loop_once(
+            lambda texts, metas: [{"service": "7", "tokens": [5]} for _ in texts]
+        )
+        self.assertEqual(router.leases, set())
+
+        worker = RedisWorker(queue=self.QUEUE, services=["7"])
+        worker.run_loop_once(Mock(side_effect=lambda texts: [{} for _ in texts]))
+        self.assertEqual(self.db.llen(bulk_queue(service_queue(self.QUEUE, "7"))), 0)
+        self.assertFalse(self.db.exists(*keys))
+
+    def test_multi_task_worker(self):
+        "Test serving several queues from one worker, the deepest first."
+
+        other_queue = self.QUEUE + "-2"
+        for i in range(3):
+            self.job(str(i), "text {}".format(i))
+        self.db.rpush(other_queue, json.dumps({"id": "other", "text": "other"}))
+
+        predict = Mock(side_effect=lambda texts: [{"labels": ["A"]} for _ in texts])
+        predict_other = Mock(side_effect=lambda texts: [{"labels": ["B"]} for _ in texts])
+        worker = MultiTaskWorker(
+            [
+                (RedisWorker(queue=self.QUEUE, max_batch_size=2), predict),
+                (RedisWorker(queue=other_queue), predict_other),
+            ],
+            max_wait=60,
+        )
+
+        worker.run_loop_once()
+        predict.assert_called_once_with(["text 0", "text 1"])
+        predict_other.assert_not_called()
+        # both queues hold one job, ties go to the first task
+        worker.run_loop_once()
+        predict.assert_called_with(["text 2"])
+        worker.run_loop_once()
+        predict_other.assert_called_once_with(["other"])
+
+        # the worker blocks on all queues
+        threading.Timer(
+            0.1,
+            lambda: self.db.rpush(other_queue, json.dumps({"id": "x", "text": "new"})),
+        ).start()
+        worker.run_loop_once()
+        predict_other.assert_called_with(["new"])
+        self.assertEqual(json.loads(self.db.get("x")), {"labels": ["B"], "status": "done"})
+
+    def test_multi_task_max_wait(self):
+        "Test serving the tasks waiting for too long before the deepest."
+
+        other_queue = self.QUEUE + "-2"
+        for i in range(4):
+            self.job(str(i), "text {}".format(i))
+        self.db.rpush(other_queue, json.dumps({"id": "other", "text": "other"}))
+
+        predict = Mock(side_effect=lambda texts: [{"labels": ["A"]} for _ in texts])
+        predict_other = Mock(side_effect=lambda texts: [{"labels": ["B"]} for _ in texts])
+        worker = MultiTaskWorker(
+            [
+                (RedisWorker(queue=self.QUEUE, max_batch_size=1), predict),
+                (RedisWorker(queue=other_queue), predict_other),
+            ],
+            max_wait=0.05,
+        )
+
+        worker.run_loop_once()
+        predict.assert_called_once_with(["text 0"])
+        time.sleep(0.1)
+        worker.run_loop_once()
+        predict_other.assert_called_once_with(["other"])
+
+    def test_multi_task_heartbeat(self):
+        "Test if the workers of the idle tasks signal that they are alive."
+
+        other_queue = self.QUEUE + "-2"
+        for i in range(3):
+            self.job(str(i), "text {}".format(i))
+
+        predict = Mock(side_effect=lambda texts: [{"labels": ["A"]} for _ in texts])
+        idle_worker = RedisWorker(queue=other_queue)
+        worker = MultiTaskWorker(
+            [
+                (RedisWorker(queue=self.QUEUE, max_batch_size=1), predict),
+                (idle_worker, Mock()),
+            ]
+        )
+
+        with self.settings(WORKER_HEARTBEAT_INTERVAL=0.05):
+            worker.run_loop_once()
+            time.sleep(0.1)
+            start = time.time()
+            worker.run_loop_once()
+
+        self.assertEqual(predict.call_count, 2)
+        for queue in [self.QUEUE, other_queue]:
+            key = settings.WORKER_HEARTBEAT_PREFIX + queue
+            self.assertGreaterEqual(self.db.zscore(key, idle_worker.worker_id), start)
+
+    def test_worker_heartbeat(self):
+        "Test if the worker signals that it is alive, even without jobs."
+
+        key = settings.WORKER_HEARTBEAT_PREFIX + self.QUEUE
+        self.db.zadd(key, {"dead-worker": time.time() - 1000})
+
+        worker = RedisWorker(queue=self.QUEUE)
+        predict = Mock()
+        with self.settings(WORKER_HEARTBEAT_INTERVAL=0.1):
+            worker.run_loop_once(predict)
+        predict.assert_not_called()
+
+        self.assertEqual(self.db.zrange(key, 0, -1), [worker.worker_id.encode()])
+        self.assertAlmostEqual(self.db.zscore(key, worker.worker_id), time.time(), delta=1)
+
+        # the throughput since the previous heartbeat
+        self.job("1", "text 1")
+        self.job("2", "text 2")
+        predict = Mock(side_effect=lambda texts: [{"labels": ["A"]} for _ in texts])
+        worker.last_heartbeat -= 2
+        worker.run_loop_once(predict)
+        worker.heartbeat(force=True)
+        throughput = float(
+            self.db.hget(settings.WORKER_THROUGHPUT_PREFIX + self.QUEUE, worker.worker_id)
+        )
+        self.assertAlmostEqual(throughput, 1, delta=0.2)
+
+    def test_stage_heartbeat(self):
+        "Test if the routers and the workers of the services report their stage."
+
+        router = RoutingWorker(queue=self.QUEUE)
+        worker = RedisWorker(queue=self.QUEUE, services=["7"])
+        router.heartbeat()
+        worker.heartbeat()
+
+        for prefix, queue in [
+            (settings.WORKER_HEARTBEAT_PREFIX, self.QUEUE),
+            (settings.WORKER_ROUTER_PREFIX, self.QUEUE),
+            (settings.WORKER_HEARTBEAT_PREFIX, service_queue(self.QUEUE, "7")),
+            (settings.WORKER_SERVICES_PREFIX, self.QUEUE),
+        ]:
+            self.assertEqual(self.db.zcard(prefix + queue), 1)
+
+    def test_heartbeat_during_long_batch(self):
+        "Test if the heartbeat is refreshed while a batch is processed."
+
+        key = settings.WORKER_HEARTBEAT_PREFIX + self.QUEUE
+        self.job("1", "text 1")
+        worker = RedisWorker(queue=self.QUEUE)
+        scores = []
+
+        def predict(texts):
+            start = time.time()
+            # longer than the heartbeat TTL
+            time.sleep(0.5)
+            scores.append((start, self.db.zscore(key, worker.worker_id)))
+            return [{"labels": ["A"]}]
+
+        with self.settings(WORKER_HEARTBEAT_INTERVAL=0.05, WORKER_HEARTBEAT_TTL=0.2):
+            worker.start_heartbeat()
+            try:
+                worker.run_loop_once(predict)
+            finally:
+                worker.stop_heartbeat()
+
+        [(start, score)] = scores
+        self.assertGreater(score, start + 0.3)
+
+    def test_worker_bulk_dequeue(self):
+        "Test if batch is popped from the queue at once and the rest is left."
+
+        for i in range(20):
+            self.job(str(i), f"my text {i}")
+
+        worker = RedisWorker(max_batch_size=16, queue=self.QUEUE)
+
+        predict = Mock(return_value=[{"labels": ["CCC001"]}] * 16)
+        worker.db.lpop = Mock(side_effect=AssertionError("lpop should not be used"))
+        worker.run_loop_once(predict)
+
+        predict.assert_called_once_with([f"my text {i}" for i in range(16)])
+        self.assertEqual(self.db.llen(self.QUEUE), 4)
+        self.assertEqual(
+            self.db.lrange(self.QUEUE, 0, -1),
+            [json.dumps({"id": str(i), "text": f"my text {i}"}).encode() for i in range(16, 20)],
+        )
+
     def test_worker_badly_formatted_data(self):
         "Test robustness to badly formatted data."
         self.db.rpush(self.QUEUE, b"Hello")
@@ -291,4 +1016,174 @@ class TestRedisWorker(TestCase):
         instance = Prediction.objects.get(id=doc_id)
         self.assertEqual(instance.labels, ["ERROR"])
         self.assertEqual(instance.status, "error")
-        self.assertEqual(instance.error_message, "test error")
\ No newline at end of file
+        self.assertEqual(instance.error_message, "test error")
+    def test_persist_batch_results_in_database(self):
+        """Test saving a batch of predictions to database."""
+
+        for doc_id in ["1", "2", "3"]:
+            self.db.rpush(
+                self.QUEUE,
+                json.dumps({"id": doc_id, "text": "mytext " + doc_id, "persist": True}),
+            )
+        Prediction.objects.create(id="1", status="queued")
+        Prediction.objects.create(id="3", status="queued")
+
+        worker = RedisWorker(queue=self.QUEUE)
+        predict = Mock(
+            return_value=[
+                {"labels": ["A"]},
+                {"labels": ["B"]},
+                {"labels": ["ERROR"], "error_message": "test error"},
+            ]
+        )
+        with self.assertLogs("tensorflow_worker.workers", level="ERROR") as cm:
+            worker.run_loop_once(predict)
+            self.assertRegex(cm.output[0], "missing database entry.*2")
+
+        self.assertFalse(Prediction.objects.filter(id="2").exists())
+        instance = Prediction.objects.get(id="1")
+        self.assertEqual(instance.labels, ["A"])
+        self.assertEqual(instance.status, "done")
+        instance = Prediction.objects.get(id="3")
+        self.assertEqual(instance.labels, ["ERROR"])
+        self.assertEqual(instance.status, "error")
+        self.assertEqual(instance.error_message, "test error")
+
+    def test_worker_pipeline(self):
+        "Test running the worker as a pipeline of preprocessing and prediction."
+
+        # the pipeline threads never stop, so they get a queue of their own
+        queue = "test-pipeline-queue"
+        worker = RedisWorker(max_batch_size=2, queue=queue)
+
+        def preprocess(texts):
+            if "fail" in texts:
+                raise Exception("preprocessing exception")
+            return [text.upper() for text in texts]
+
+        def predict(data):
+            return [{"labels": [d]} for d in data]
+
+        # batches: [one, two], [three, four], [fail]
+        for i, text in enumerate(["one", "two", "three", "four", "fail"]):
+            self.db.rpush(
+                queue,
+                json.dumps({"id": str(i), "text": text, "reply_to": "reply:" + text}),
+            )
+
+        thread = threading.Thread(
+            target=worker.run_pipeline, args=(predict, preprocess), daemon=True
+        )
+        thread.start()
+
+        for text in ["one", "two", "three", "four"]:
+            _, data = self.db.blpop("reply:" + text, timeout=5)
+            [result] = json.loads(data)
+            self.assertEqual(result["labels"], [text.upper()])
+
+        _, data = self.db.blpop("reply:fail", timeout=5)
+        [result] = json.loads(data)
+        self.assertEqual(result["status"], "error")
+
+    def test_worker_adaptive_batch(self):
+        "Test if the adaptive worker waits for stragglers within its window."
+
+        self.job("0", "text 0")
+        # window of 250 ms: half of the maximum window for half of the batch
+        policy = AdaptiveBatchPolicy(latency_slo=5000, max_batch_size=2, max_window=500)
+        worker = RedisWorker(queue=self.QUEUE, policy=policy)
+
+        threading.Timer(0.05, lambda: self.job("1", "text 1")).start()
+        predict = Mock(return_value=[{"labels": ["A"]}] * 2)
+        worker.run_loop_once(predict)
+        predict.assert_called_once_with(["text 0", "text 1"])
+
+        # no straggler: returns at the end of the window
+        self.job("2", "text 2")
+        start = time.time()
+        predict = Mock(return_value=[{"labels": ["A"]}])
+        worker.run_loop_once(predict)
+        predict.assert_called_once_with(["text 2"])
+        self.assertGreater(time.time() - start, 0.2)
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(len(policy.latencies), 2)
+
+    def test_worker_pool_restarts_processes(self):
+        "Test if the worker pool restarts the processes that exited."
+
+        def target():
+            redis.Redis(settings.REDIS_HOST).rpush("pool-test", os.getpid())
+
+        pool = WorkerPool(2, target)
+        pool.RESTART_DELAY = 0.01
+        timer = threading.Timer(0.5, pool.stop)
+        timer.start()
+        pool.run()
+        timer.join()
+
+        self.assertEqual(pool.children, set())
+        pids = set(self.db.lrange("pool-test", 0, -1))
+        self.assertGreater(len(pids), 2)
+
+    def test_worker_pool_stopped_during_restart(self):
+        "Test if the worker pool does not restart processes once stopped."
+
+        def target():
+            redis.Redis(settings.REDIS_HOST).rpush("pool-test", os.getpid())
+
+        pool = WorkerPool(2, target)
+        pool.RESTART_DELAY = 0.5
+        # stop while waiting to restart the first process that exited
+        timer = threading.Timer(0.2, pool.stop)
+        timer.start()
+        pool.run()
+        timer.join()
+
+        self.assertEqual(pool.children, set())
+        self.assertEqual(self.db.llen("pool-test"), 2)
+
+    def test_describe_exit(self):
+        "Test decoding the exit status of the worker processes."
+
+        self.assertEqual(WorkerPool.describe_exit(3 << 8), "exited with status 3")
+        self.assertEqual(
+            WorkerPool.describe_exit(signal.SIGKILL), "was killed by signal 9"
+        )
+
+
+@tag("worker")
+class TestAdaptiveBatchPolicy(TestCase):
+    """Test adaptive batching policy."""
+
+    def test_batch_size(self):
+        "Test if the batch size is bounded by the SLO, not by the queue depth."
+
+        policy = AdaptiveBatchPolicy(latency_slo=100, max_batch_size=32)
+        self.assertEqual(policy.batch_size(1), 32)
+        self.assertEqual(policy.batch_size(100), 32)
+        # the worker waits for the missing jobs
+        self.assertGreater(policy.window(1, policy.batch_size(1)), 0)
+
+        # 10 ms per job
+        policy.record(4, 0.04, 0.05)
+        self.assertAlmostEqual(policy.time_per_job, 0.01)
+        self.assertEqual(policy.batch_size(1), 10)
+        self.assertEqual(policy.batch_size(100), 10)
+
+    def test_window(self):
+        "Test if the window shrinks with queue depth and latency above SLO."
+
+        policy = AdaptiveBatchPolicy(latency_slo=100, max_batch_size=10)
+        self.assertEqual(policy.window(10, 10), 0)
+        self.assertAlmostEqual(policy.window(5, 10), 50)
+        self.assertAlmostEqual(policy.window(1, 10), 10)
+
+        # 5 ms per job
+        policy.record(2, 0.01, 0.05)
+        self.assertAlmostEqual(policy.window(5, 10), 25)
+
+        # latencies above SLO shrink the window
+        for _ in range(10):
+            policy.record(2, 0.01, 0.2)
+        self.assertLess(policy.window(5, 10), 25)
+        self.assertGreaterEqual(policy.scale, 0.1)
@@ -1,31 +1,248 @@
 from django.conf import settings
+from django.db import transaction
 import redis
 import time
-import json
+import functools
 import logging
+import math
 import os
+import signal
+import socket
 import sys
+import threading
+from collections import deque
+from queue import Queue
+from predict.cache import InflightRegistry, ResultCache, normalize_text
+from predict.messages import decode, encode
 from predict.models import Prediction
+from predict.queues import DOORBELL, bulk_queue, tenant_queue, tenants_key
 
 logger = logging.getLogger(__name__)
 
 
+# Atomically pop up to ARGV[1] messages from the head of the queue KEYS[1]. The
+# doorbells (including the ones already popped, passed in ARGV[3..]) are
+# replaced with the messages of the active tenants in turn: the tenant at the
+# front of the ring KEYS[2] gives a message from its sub-queue (prefix ARGV[2])
+# and goes to the back.
+POP_BATCH_SCRIPT = """
+local items = {}
+if tonumber(ARGV[1]) > 0 then
+    items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+    if #items > 0 then
+        redis.call('LTRIM', KEYS[1], #items, -1)
+    end
+end
+for i = 3, #ARGV do
+    table.insert(items, ARGV[i])
+end
+local messages = {}
+local rung = 0
+for _, item in ipairs(items) do
+    if string.byte(item, 1) == 0 then
+        rung = rung + 1
+    else
+        table.insert(messages, item)
+    end
+end
+while rung > 0 do
+    local tenant = redis.call('ZRANGE', KEYS[2], 0, 0)[1]
+    if not tenant then
+        break
+    end
+    local queue = ARGV[2] .. tenant
+    local message = redis.call('LPOP', queue)
+    if redis.call('LLEN', queue) > 0 then
+        local last = redis.call('ZRANGE', KEYS[2], -1, -1, 'WITHSCORES')
+        redis.call('ZADD', KEYS[2], tonumber(last[2]) + 1, tenant)
+    else
+        redis.call('ZREM', KEYS[2], tenant)
+    end
+    if message then
+        table.insert(messages, message)
+        rung = rung - 1
+    end
+end
+return messages
+"""
+
+
 class MessageError(Exception):
     pass
 
 
+def service_queue(queue, service_id):
+    "Return the queue of the jobs routed to the CCAM model of a service."
+
+    return "{}:service:{}".format(queue, service_id)
+
+
+class BatchPolicy:
+    """Static batching: batches of at most max_batch_size jobs, collected during
+    at most timeout ms."""
+
+    # the static policy does not need the queue depth
+    uses_depth = False
+
+    def __init__(self, max_batch_size=16, timeout=None):
+        self.max_batch_size = max_batch_size
+        self.timeout = timeout
+
+    def batch_size(self, depth):
+        "Return the maximum number of jobs in the next batch."
+        return self.max_batch_size
+
+    def window(self, depth, batch_size):
+        "Return the time (in ms) to wait for the jobs of the next batch."
+        return self.timeout
+
+    def record(self, batch_size, inference_time, latency):
+        "Record the inference time and latency (in seconds) of a batch."
+
+
+class AdaptiveBatchPolicy(BatchPolicy):
+    """Adapt the batch size and the batching window to the latency SLO.
+
+    The inference time per job is estimated from the recent batches. The target
+    batch size is the largest one (up to max_batch_size) whose estimated
+    inference time fits in the latency SLO. When fewer jobs are waiting, the
+    worker waits for stragglers during the remaining part of the SLO, scaled
+    down when the queue is shallow (there is little to gain by waiting) and when
+    the measured p95 latency of the batches exceeds the SLO.
+    """
+
+    uses_depth = True
+
+    def __init__(
+        self,
+        latency_slo,
+        max_batch_size=16,
+        min_batch_size=1,
+        max_window=None,
+        smoothing=0.2,
+        history=100,
+    ):
+        """latency_slo: target p95 latency of batches (in ms)
+        max_window: upper limit of the batching window (in ms)
+        smoothing: weight of the last batch in the moving average of inference times
+        history: number of batches used to compute the p95 latency"""
+
+        super().__init__(max_batch_size=max_batch_size, timeout=max_window)
+        self.latency_slo = latency_slo / 1000
+        self.min_batch_size = min_batch_size
+        self.max_window = max_window / 1000 if max_window else self.latency_slo
+        self.smoothing = smoothing
+        self.latencies = deque(maxlen=history)
+        self.time_per_job = None
+        self.scale = 1.0
+
+    def estimated_time(self, batch_size):
+        return (self.time_per_job or 0) * batch_size
+
+    def batch_size(self, depth):
+        # the target does not depend on the depth, the window waits for the
+        # missing jobs
+        size = self.max_batch_size
+        if self.time_per_job:
+            size = min(size, int(self.latency_slo / self.time_per_job))
+        return max(self.min_batch_size, size)
+
+    def window(self, depth, batch_size):
+        if depth >= batch_size:
+            return 0
+        budget = self.latency_slo * self.scale - self.estimated_time(batch_size)
+        budget = min(self.max_window, max(budget, 0))
+        return budget * depth / batch_size * 1000
+
+    def p95_latency(self):
+        latencies = sorted(self.latencies)
+        return latencies[int(0.95 * (len(latencies) - 1))]
+
+    def record(self, batch_size, inference_time, latency):
+        time_per_job = inference_time / batch_size
+        if self.time_per_job is None:
+            self.time_per_job = time_per_job
+        else:
+            self.time_per_job += self.smoothing * (time_per_job - self.time_per_job)
+
+        self.latencies.append(latency)
+        if self.p95_latency() > self.latency_slo:
+            self.scale = max(0.1, self.scale * 0.9)
+        else:
+            self.scale = min(1.0, self.scale * 1.05)
+
+
 class RedisWorker:
     """Worker based on Redis queue."""
 
-    def __init__(self, max_batch_size=16, queue=None, timeout=None):
-        """Create a new worker that monitors jobs in queue and time outs after timeout."""
+    def __init__(
+        self,
+        max_batch_size=16,
+        queue=None,
+        timeout=None,
+        result_ttl=None,
+        policy=None,
+        pass_meta=False,
+        model_version=None,
+        services=None,
+        bulk_share=0,
+    ):
+        """Create a new worker that monitors jobs in queue and time outs after timeout.
+
+        The results are kept in redis for result_ttl seconds (REDIS_RESULT_TTL by
+        default, 0 to keep them forever). The batches are formed according to
+        policy (by default BatchPolicy with max_batch_size and timeout). If
+        pass_meta is True, the classifier is called with the job metadata as
+        second argument. If model_version is given, the worker publishes it and
+        stores its results in the result cache of the queue. If services are
+        given, the worker processes the jobs routed to these services (see
+        RoutingWorker) instead of the jobs of the queue.
+
+        The synchronous jobs of a queue are processed before the asynchronous
+        jobs of its bulk lane. With bulk_share (between 0 and 1), the bulk lane
+        is served first for this share of the batches, so that the bulk jobs
+        are not starved when the synchronous traffic is high."""
         logger.info("Connecting to redis at %s", settings.REDIS_HOST)
-        self.timeout = timeout
+        if result_ttl is None:
+            result_ttl = settings.REDIS_RESULT_TTL
+        self.result_ttl = result_ttl or None
         self.db = redis.Redis(host=settings.REDIS_HOST)
-        self.max_batch_size = max_batch_size
+        self.policy = policy or BatchPolicy(max_batch_size, timeout)
+        self.pass_meta = pass_meta
+        self._pop_batch_script = self.db.register_script(POP_BATCH_SCRIPT)
         self.wait_for_redis()
 
         self.QUEUE = queue or settings.REDIS_SURGERY_QUEUE
+        self.model_version = model_version
+        self.result_cache = ResultCache(self.db, self.QUEUE) if model_version else None
+        self.inflight = InflightRegistry(self.db, self.QUEUE)
+        # queues the jobs are popped from
+        if services:
+            self.queues = [service_queue(self.QUEUE, s) for s in services]
+        else:
+            self.queues = [self.QUEUE]
+        # (high priority, bulk) lanes of each queue
+        self.lanes = [(q, bulk_queue(q)) for q in self.queues]
+        self.bulk_share = bulk_share
+        self.bulk_credit = 0.0
+        # lanes of the last message received
+        self.current_lanes = self.lanes[0]
+        self.worker_id = "{}:{}".format(socket.gethostname(), os.getpid())
+        # heartbeat of the stage of the split deployment (see ReadinessView)
+        self.stage_key = (
+            settings.WORKER_SERVICES_PREFIX + self.QUEUE if services else None
+        )
+        self.last_heartbeat = None
+        # messages popped since the last heartbeat
+        self.popped = 0
+        self._heartbeat_lock = threading.Lock()
+        self._heartbeat_stopped = threading.Event()
+        # jobs popped from the queue but not processed yet
+        self.buffer = deque()
+        # estimated number of jobs per message (envelopes hold several jobs)
+        self.jobs_per_message = 1.0
+        # in flight keys of the asynchronous leaders held by the worker
+        self.leases = set()
 
     def wait_for_redis(self):
         "Wait for redis being ready."
@@ -37,108 +254,747 @@ class RedisWorker:
             except redis.RedisError:
                 time.sleep(0.1)
 
+    def heartbeat(self, force=False):
+        """Signal that the worker is ready to process jobs from its queue.
+
+        The time of the last heartbeat of each worker is stored in a sorted set
+        per queue (and per stage of the split deployment), which the API uses
+        to check that the workers are alive. The
+        number of messages popped per second since the previous heartbeat is
+        published too (hash per queue), to estimate the throughput of the
+        workers, and the leases of the asynchronous jobs it holds are renewed."""
+
+        with self._heartbeat_lock:
+            now = time.time()
+            if (
+                not force
+                and self.last_heartbeat
+                and now - self.last_heartbeat < settings.WORKER_HEARTBEAT_INTERVAL
+            ):
+                return
+            pipe = self.db.pipeline(transaction=False)
+            keys = [settings.WORKER_HEARTBEAT_PREFIX + queue for queue in self.queues]
+            if self.stage_key:
+                keys.append(self.stage_key)
+            for key in keys:
+                pipe.zadd(key, {self.worker_id: now})
+                # forget the workers that died
+                pipe.zremrangebyscore(key, "-inf", now - settings.WORKER_HEARTBEAT_TTL)
+            if self.last_heartbeat:
+                rate = self.popped / (now - self.last_heartbeat)
+                for queue in self.queues:
+                    key = settings.WORKER_THROUGHPUT_PREFIX + queue
+                    pipe.hset(key, self.worker_id, rate)
+                    pipe.pexpire(key, int(settings.WORKER_HEARTBEAT_TTL * 1000))
+            if self.result_cache is not None:
+                self.result_cache.publish_version(self.model_version, pipe)
+            self.inflight.renew(tuple(self.leases), pipe)
+            pipe.execute()
+            self.last_heartbeat = now
+            self.popped = 0
+
+    def start_heartbeat(self):
+        """Refresh the heartbeat from a background thread.
+
+        The worker stays ready while it processes a batch longer than the
+        heartbeat TTL (e.g. loading a CCAM model)."""
+
+        def refresh():
+            while not self._heartbeat_stopped.wait(settings.WORKER_HEARTBEAT_INTERVAL):
+                try:
+                    self.heartbeat()
+                except redis.RedisError:
+                    logger.warning("heartbeat failed: %s", sys.exc_info()[0])
+
+        self._heartbeat_stopped.clear()
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def stop_heartbeat(self):
+        "Stop the background heartbeat thread."
+
+        self._heartbeat_stopped.set()
+
     def deserialize(self, serialized_data):
-        "Deserialize input data from JSON"
+        """Deserialize a message as a list of (request_id, text, meta) jobs.
+
+        A message is either a single job or an envelope with the jobs of a
+        request chunk in "jobs" and the metadata they share (e.g. reply_to)."""
 
         try:
-            data = json.loads(serialized_data)
-        except json.JSONDecodeError:
+            data = decode(serialized_data)
+        except ValueError:
             logger.error(
                 "Obtained badly formatted data from redis queue: %s", serialized_data
             )
             raise MessageError
 
+        if isinstance(data, dict) and "jobs" in data:
+            jobs = data.pop("jobs")
+            shared = data
+        else:
+            jobs = [data]
+            shared = {}
+
         try:
-            text = data.pop("text")
-            request_id = data.pop("id")
-            meta = data
-        except KeyError as exc:
+            return [
+                (job.pop("id"), job.pop("text"), {**shared, **job}) for job in jobs
+            ]
+        except (KeyError, AttributeError, TypeError) as exc:
             logger.error("Missing key '%s' in the message: %s", exc, serialized_data)
             raise MessageError
 
-        return request_id, text, meta
+    def unpack(self, messages, size=None):
+        """Add the jobs of the messages to the buffer of jobs, skipping bad messages.
 
-    def run_loop_once(self, predict):
+        With size, the messages are unpacked only until the buffer holds size
+        jobs. Returns the messages left."""
 
-        logger.info("waiting for new jobs")
-        _, serialized_data = self.db.blpop(self.QUEUE)
+        buffered = len(self.buffer)
+        unpacked = 0
+        for serialized_data in messages:
+            if size is not None and len(self.buffer) >= size:
+                break
+            unpacked += 1
+            try:
+                jobs = self.deserialize(serialized_data)
+            except MessageError:
+                continue
+            self.buffer.extend(jobs)
+            self.leases.update(
+                meta["inflight"]
+                for _, _, meta in jobs
+                if meta.get("inflight") and not meta.get("deadline")
+            )
+        self.popped += unpacked
+        if unpacked:
+            self.jobs_per_message = max((len(self.buffer) - buffered) / unpacked, 1)
+        return messages[unpacked:]
 
-        try:
-            request_id, text, meta = self.deserialize(serialized_data)
-        except MessageError:
-            return
+    def receive(self, queue, message):
+        """Unpack a message popped (by BLPOP) from one of the lanes of the worker.
+
+        The batch is completed from the lanes of the same queue."""
+
+        if isinstance(queue, bytes):
+            queue = queue.decode()
+        self.current_lanes = next(pair for pair in self.lanes if queue in pair)
+        if message.startswith(DOORBELL):
+            self.unpack(self.pop_batch(1, queue, [message]))
+        else:
+            self.unpack([message])
+
+    def pop_batch(self, size, queue=None, popped=()):
+        """Pop up to size messages from the queue in a single atomic operation.
+
+        The messages of the tenants wait in their sub-queues (see tenant_queue)
+        and a doorbell is pushed to the queue for each of them. The doorbells
+        are replaced with the messages of the active tenants in turn, so that
+        the batches are shared fairly between the tenants. The messages already
+        popped from the queue (by BLPOP) are passed in popped and count in size."""
+
+        if size <= 0 and not popped:
+            return []
+        queue = queue or self.queues[0]
+        return self._pop_batch_script(
+            keys=[queue, tenants_key(queue)],
+            args=[max(size - len(popped), 0), tenant_queue(queue, ""), *popped],
+        )
+
+    def fill_buffer(self, size, queue):
+        """Pop messages from the queue until the buffer holds size jobs.
+
+        The number of messages popped at once is estimated from the jobs
+        missing and the size of the last messages (envelopes hold several
+        jobs). The messages that do not fit go back to the head of the queue,
+        so that the buffer exceeds size by less than an envelope. Stops when
+        the queue is empty."""
+
+        while len(self.buffer) < size:
+            n = math.ceil((size - len(self.buffer)) / self.jobs_per_message)
+            messages = self.pop_batch(n, queue)
+            left = self.unpack(messages, size)
+            if left:
+                self.db.lpush(queue, *reversed(left))
+                break
+            if len(messages) < n:
+                break
+
+    def fetch_batch(self, size, start_time, timeout, queue=None):
+        """Fill the buffer up to size jobs without blocking longer than the timeout.
+
+        The messages already in the queue are popped at once, the stragglers
+        are awaited with a blocking pop until timeout (in ms) since start_time."""
+
+        queue = queue or self.queues[0]
+        self.fill_buffer(size, queue)
+        while len(self.buffer) < size and timeout:
+            remaining = timeout / 1000 - (time.time() - start_time)
+            if remaining <= 0:
+                break
+            # redis treats timeouts rounded down to 0 ms as infinite
+            item = self.db.blpop(queue, timeout=max(remaining, 0.01))
+            if item is None:
+                break
+            self.receive(*item)
+            self.fill_buffer(size, queue)
+
+    def drop_expired(self, ids, texts, metas):
+        "Remove the jobs whose deadline passed, nobody waits for their results."
+
+        now = time.time()
+        valid = [
+            i for i, meta in enumerate(metas)
+            if not meta.get("deadline") or meta["deadline"] > now
+        ]
+        if len(valid) < len(ids):
+            logger.warning("dropping %d expired jobs", len(ids) - len(valid))
+            # the waiters of the expired jobs have earlier deadlines
+            expired = set(range(len(ids))).difference(valid)
+            self.claim_waiters(
+                [metas[i]["inflight"] for i in expired if metas[i].get("inflight")]
+            )
+        return (
+            [ids[i] for i in valid],
+            [texts[i] for i in valid],
+            [metas[i] for i in valid],
+        )
+
+    def next_batch(self):
+        """Wait for new jobs and return the next batch as (ids, texts, metas, start_time).
+
+        Returns None if there are no valid jobs in the batch."""
 
-        texts = [text]
-        ids = [request_id]
-        metas = [meta]
+        self.heartbeat()
+        # the bulk lanes are served first for bulk_share of the batches
+        self.bulk_credit += self.bulk_share
+        bulk_first = self.bulk_credit >= 1
+        if bulk_first:
+            self.bulk_credit -= 1
+        if not self.buffer:
+            logger.debug("waiting for new jobs")
+            # wake up regularly to refresh the heartbeat
+            item = self.db.blpop(
+                self.lane_order(bulk_first), timeout=settings.WORKER_HEARTBEAT_INTERVAL
+            )
+            if item is None:
+                return None
+            self.receive(*item)
 
-        n_examples = 1
         start_time = time.time()
-        while n_examples < self.max_batch_size:
-            serialized_data = self.db.lpop(self.QUEUE)
-            if serialized_data is None:
-                current_time = time.time()
-                # if did not pass timeout yet wait for more jobs 
-                if self.timeout and (current_time - start_time) * 1000 < self.timeout:
-                    time.sleep(0.050)
-                    continue
-                else:
-                    break
-            try:
-                request_id, text, meta = self.deserialize(serialized_data)
-                texts.append(text)
-                ids.append(request_id)
-                metas.append(meta)
-                n_examples += 1
-            except MessageError:
-                continue
+        # the depth (in jobs) includes the jobs already popped, the lanes hold
+        # messages of jobs_per_message jobs on average
+        depth = (
+            sum(self.db.llen(q) for pair in self.lanes for q in pair)
+            * self.jobs_per_message
+            + len(self.buffer)
+            if self.policy.uses_depth
+            else None
+        )
+        batch_size = self.policy.batch_size(depth)
+        timeout = self.policy.window(depth, batch_size)
+        if self.buffer:
+            # the rest of the batch comes from the lanes of the same queue, the
+            # jobs already waiting are taken in priority order
+            high, bulk = self.current_lanes
+            for queue in (bulk, high) if bulk_first else (high, bulk):
+                self.fill_buffer(batch_size, queue)
+            # only the synchronous stragglers are worth waiting for
+            self.fetch_batch(batch_size, start_time, timeout, high)
+
+        # the jobs of the envelopes that do not fit are left for the next batch
+        jobs = [self.buffer.popleft() for _ in range(min(batch_size, len(self.buffer)))]
+        if not jobs:
+            return None
+        ids, texts, metas = (list(values) for values in zip(*jobs))
+
+        ids, texts, metas = self.drop_expired(ids, texts, metas)
+        if not texts:
+            return None
+
+        return ids, texts, metas, start_time
+
+    def lane_order(self, bulk_first=False):
+        "Return the lanes in the order they are served (high priority first)."
+
+        high = [pair[0] for pair in self.lanes]
+        bulk = [pair[1] for pair in self.lanes]
+        return bulk + high if bulk_first else high + bulk
+
+    def with_meta(self, func, metas):
+        "Bind the job metadata to the classifier function if it uses them."
+
+        if self.pass_meta:
+            return functools.partial(func, metas=metas)
+        return func
+
+    def deduplicate(self, texts, metas):
+        """Return the distinct documents of a batch as (texts, metas, index).
+
+        Identical texts with the same service hint are predicted once, index
+        gives the position of the document of each job."""
+
+        positions = {}
+        first = []
+        index = []
+        for i, (text, meta) in enumerate(zip(texts, metas)):
+            key = (normalize_text(text), meta.get("service"))
+            if key not in positions:
+                positions[key] = len(first)
+                first.append(i)
+            index.append(positions[key])
+
+        return [texts[i] for i in first], [metas[i] for i in first], index
+
+    @staticmethod
+    def expand(outputs, index):
+        "Return the outputs of the distinct documents for each job of the batch."
+
+        return [dict(outputs[i]) for i in index]
+
+    def claim_waiters(self, keys):
+        """Remove the documents from the in flight documents and return their waiters.
+
+        The waiters are dropped if redis is not available, they fail with
+        their timeout."""
+
+        self.leases.difference_update(keys)
+        try:
+            return self.inflight.claim(keys)
+        except redis.RedisError:
+            logger.warning("could not claim the waiting jobs", exc_info=True)
+            return [[] for _ in keys]
+
+    def predict_batch(self, predict, data, texts, start_time):
+        "Run the prediction and record its timing in the batch policy."
+
+        logger.info("sending %d new jobs to classfier", len(texts))
+        inference_start = time.time()
+        outputs = self.apply_classifier(predict, data, texts)
+        end_time = time.time()
+        self.policy.record(len(texts), end_time - inference_start, end_time - start_time)
+        return outputs
+
+    def apply_classifier(self, func, data, texts):
+        "Call classifier function on data and return error outputs if it fails."
 
-        logger.info("sending %d new jobs to classfier", n_examples)
         try:
-            outputs = predict(texts)
+            return func(data)
         except Exception as exc:
             logger.error(
                 "classifier failed for inputs %s with message %s", texts, str(exc)
             )
-            outputs = [
-                {
-                    "labels": ("ERROR",),
-                    "error_message": "classifier raised an unexpected exception",
-                }
-                for _ in texts
-            ]
+            return self.error_outputs(texts)
+
+    def error_outputs(self, texts):
+        return [
+            {
+                "labels": ("ERROR",),
+                "error_message": "classifier raised an unexpected exception",
+            }
+            for _ in texts
+        ]
+
+    def run_loop_once(self, predict):
+
+        batch = self.next_batch()
+        if batch is None:
+            return
+        ids, texts, metas, start_time = batch
+        unique_texts, unique_metas, index = self.deduplicate(texts, metas)
 
-        self.send_results(ids, outputs, metas)
+        outputs = self.predict_batch(
+            self.with_meta(predict, unique_metas), unique_texts, unique_texts, start_time
+        )
 
-    def send_results(self, ids, outputs, metas):
-        """Send results via redis or persist them in the database."""
+        self.send_results(ids, self.expand(outputs, index), metas, texts)
 
-        for label_id, labels, meta in zip(ids, outputs, metas):
+    def send_results(self, ids, outputs, metas, texts=None):
+        """Send results via redis or persist them in the database.
+
+        The results of the documents in flight are sent to their waiters too.
+        The successful results are also stored in the result cache if the
+        texts are given."""
+
+        pipe = self.db.pipeline(transaction=False)
+        n_results = 0
+        persisted = {}
+        replies = {}
+        cached = []
+        for i, (labels, meta) in enumerate(zip(outputs, metas)):
             labels['status'] = 'error' if "error_message" in labels else "done"
-            if not meta.get("persist"):
-                logger.info("setting results for request id %s in redis", label_id)
-                self.db.set(label_id, json.dumps(labels))
+            if texts is not None and labels['status'] == "done":
+                result = {k: v for k, v in labels.items() if k != "status"}
+                cached.append((texts[i], meta.get("service"), result))
+
+        jobs = list(zip(ids, outputs, metas))
+        leaders = [i for i, meta in enumerate(metas) if meta.get("inflight")]
+        waiters = self.claim_waiters([metas[i]["inflight"] for i in leaders])
+        for i, doc_waiters in zip(leaders, waiters):
+            for waiter in doc_waiters:
+                jobs.append((waiter.pop("id"), outputs[i], waiter))
+
+        for label_id, labels, meta in jobs:
+            if meta.get("persist"):
+                persisted[label_id] = labels
+                # identical documents of the request
+                for duplicate_id in meta.get("duplicates", ()):
+                    persisted[duplicate_id] = labels
+            elif meta.get("reply_to"):
+                replies.setdefault(meta["reply_to"], []).append(
+                    {"id": label_id, **labels}
+                )
             else:
-                try: 
-                    logger.info("saving results for request id %s in the database", label_id)
-                    instance = Prediction.objects.get(id=label_id)
-                    instance.label_string = ",".join(labels['labels'])
-                    instance.error_message = labels.get('error_message')
-                    instance.status = labels['status']
-                    instance.save()
-                except Prediction.DoesNotExist:
-                    logger.error("missing database entry for request id %s", label_id)
+                pipe.set(label_id, encode(labels), ex=self.result_ttl)
+                n_results += 1
 
+        # one reply per request and batch wakes up the waiting view only once
+        for reply_key, results in replies.items():
+            pipe.rpush(reply_key, encode(results))
+            if self.result_ttl:
+                pipe.expire(reply_key, self.result_ttl)
+            n_results += len(results)
 
-    def run_loop(self, predict):
+        if n_results:
+            logger.info("setting results for %d request ids in redis", n_results)
+            pipe.execute()
+
+        if persisted:
+            self.persist_results(persisted)
+
+        if cached and self.result_cache is not None:
+            try:
+                self.result_cache.set_many(self.model_version, cached)
+            except redis.RedisError:
+                logger.warning("could not store results in the cache", exc_info=True)
+
+    def persist_results(self, results):
+        """Update the database entries of the predictions in a single transaction.
+
+        results: dictionary mapping request ids to labels"""
+
+        logger.info("saving results for %d request ids in the database", len(results))
+        with transaction.atomic():
+            instances = Prediction.objects.in_bulk(list(results))
+            for label_id, labels in results.items():
+                instance = instances.get(label_id)
+                if instance is None:
+                    logger.error("missing database entry for request id %s", label_id)
+                    continue
+                instance.label_string = ",".join(labels['labels'])
+                instance.error_message = labels.get('error_message')
+                instance.status = labels['status']
+            Prediction.objects.bulk_update(
+                instances.values(), ["label_string", "error_message", "status"]
+            )
+
+    def run_forever(self, step):
+        "Call step repeatedly, surviving redis disconnections and unexpected errors."
 
-        # poll for requests
         while True:
             try:
-                self.run_loop_once(predict)
+                step()
             except redis.exceptions.ConnectionError:
                 # try to reconnect
                 logger.info("Connection to redis lost. Trying to reconnect.")
                 self.wait_for_redis()
             except Exception:
                 logger.error("Unexpected error: %s", sys.exc_info()[0])
+
+    def run_loop(self, predict):
+
+        self.start_heartbeat()
+        # poll for requests
+        self.run_forever(lambda: self.run_loop_once(predict))
+
+    def run_pipeline(self, predict, preprocess=None):
+        """Run the worker as a pipeline of concurrent stages.
+
+        A background thread dequeues the next batch and preprocesses it (for
+        example tokenizes the texts), while the current batch is predicted in
+        the calling thread and the results of the previous batch are published
+        by another background thread. The throughput is then bounded by the
+        slowest stage rather than the sum of all stages.
+
+        predict: function called with the output of preprocess
+        preprocess: function called with the list of texts (identity if None),
+            and the job metadata if pass_meta is set
+        """
+
+        prepared = Queue(maxsize=1)
+        finished = Queue(maxsize=1)
+        self.start_heartbeat()
+
+        def fetch_stage():
+            batch = self.next_batch()
+            if batch is None:
+                return
+            ids, texts, metas, start_time = batch
+            unique_texts, unique_metas, index = self.deduplicate(texts, metas)
+            data = unique_texts
+            if preprocess is not None:
+                try:
+                    data = self.with_meta(preprocess, unique_metas)(unique_texts)
+                except Exception as exc:
+                    logger.error(
+                        "classifier failed for inputs %s with message %s",
+                        texts,
+                        str(exc),
+                    )
+                    finished.put((ids, self.error_outputs(texts), metas, None))
+                    return
+            prepared.put(
+                (ids, texts, metas, data, start_time, unique_texts, unique_metas, index)
+            )
+
+        def publish_stage():
+            ids, outputs, metas, texts = finished.get()
+            self.send_results(ids, outputs, metas, texts)
+
+        for stage in (fetch_stage, publish_stage):
+            thread = threading.Thread(
+                target=self.run_forever, args=(stage,), daemon=True
+            )
+            thread.start()
+
+        def predict_stage():
+            batch = prepared.get()
+            ids, texts, metas, data, start_time, unique_texts, unique_metas, index = batch
+            # the metadata are passed to preprocess if there is one
+            func = predict if preprocess else self.with_meta(predict, unique_metas)
+            outputs = self.predict_batch(func, data, unique_texts, start_time)
+            finished.put((ids, self.expand(outputs, index), metas, texts))
+
+        self.run_forever(predict_stage)
+
+
+class RoutingWorker(RedisWorker):
+    """First stage of the split CCAM deployment.
+
+    The classifier function returns the service id and tokens of each document
+    (see BertCCAMClassifier.route), or its error. The documents are forwarded
+    to the queue of their service, whose workers keep the CCAM model of the
+    service in memory, and the errors are sent to the clients."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stage_key = settings.WORKER_ROUTER_PREFIX + self.QUEUE
+
+    def send_results(self, ids, outputs, metas, texts=None):
+        "Forward the routed jobs to the service queues and send the errors."
+
+        routed = {}
+        errors = []
+        for i, (label_id, output, meta) in enumerate(zip(ids, outputs, metas)):
+            if "service" not in output:
+                errors.append(i)
+                continue
+            # the service hint of the client (if any) is kept for the result cache
+            job = {"id": label_id, "text": texts[i], **meta}
+            job["routed_service"] = output["service"]
+            job["tokens"] = output["tokens"]
+            queue = service_queue(self.QUEUE, output["service"])
+            # the asynchronous jobs stay in the bulk lanes
+            if meta.get("persist"):
+                queue = bulk_queue(queue)
+            routed.setdefault(queue, []).append(job)
+
+        if routed:
+            pipe = self.db.pipeline(transaction=False)
+            for queue, jobs in routed.items():
+                pipe.rpush(queue, encode({"jobs": jobs}))
+            logger.info(
+                "routing %d jobs to %d service queues",
+                sum(len(jobs) for jobs in routed.values()),
+                len(routed),
+            )
+            pipe.execute()
+            # the workers of the services hold the leases of the routed jobs
+            self.leases.difference_update(
+                job["inflight"]
+                for jobs in routed.values()
+                for job in jobs
+                if job.get("inflight")
+            )
+
+        if errors:
+            super().send_results(
+                [ids[i] for i in errors],
+                [outputs[i] for i in errors],
+                [metas[i] for i in errors],
+            )
+
+
+class MultiTaskWorker:
+    """Serve several tasks (queues) from one process, keeping all models in memory.
+
+    Each task has its own RedisWorker and classifier function. The next batch
+    is taken from the task with the most messages waiting, unless a task waits
+    for more than max_wait seconds, which is served first. When all the queues
+    are empty, the worker blocks on the lanes of all tasks."""
+
+    def __init__(self, tasks, max_wait=1.0):
+        "tasks: list of (RedisWorker, classifier function)"
+
+        self.tasks = tasks
+        self.max_wait = max_wait
+        self.db = tasks[0][0].db
+        # time since which each task has messages waiting
+        self.waiting_since = [None] * len(tasks)
+
+    def depths(self):
+        "Return the number of messages waiting for each task (including the popped jobs)."
+
+        pipe = self.db.pipeline(transaction=False)
+        for worker, _ in self.tasks:
+            for queue in worker.lane_order():
+                pipe.llen(queue)
+        lengths = iter(pipe.execute())
+        return [
+            sum(next(lengths) for _ in worker.lane_order()) + len(worker.buffer)
+            for worker, _ in self.tasks
+        ]
+
+    def next_task(self):
+        """Return the index of the task to serve next (None if there are no jobs).
+
+        The worker of the task has at least one job in its buffer."""
+
+        # the workers of the idle tasks stay alive while the others are busy
+        for worker, _ in self.tasks:
+            worker.heartbeat()
+        now = time.time()
+        depths = self.depths()
+        for i, depth in enumerate(depths):
+            if not depth:
+                self.waiting_since[i] = None
+            elif self.waiting_since[i] is None:
+                self.waiting_since[i] = now
+
+        if any(depths):
+            waiting = [i for i, depth in enumerate(depths) if depth]
+            task = min(waiting, key=lambda i: self.waiting_since[i])
+            if now - self.waiting_since[task] <= self.max_wait:
+                task = max(waiting, key=lambda i: depths[i])
+            worker = self.tasks[task][0]
+            if worker.buffer:
+                return task
+            # another process may have taken the jobs meanwhile
+            item = self.db.blpop(worker.lane_order(), timeout=0.01)
+        else:
+            logger.debug("waiting for new jobs")
+            lanes = [pair for worker, _ in self.tasks for pair in worker.lanes]
+            # the synchronous jobs of all tasks come first
+            item = self.db.blpop(
+                [high for high, _ in lanes] + [bulk for _, bulk in lanes],
+                timeout=settings.WORKER_HEARTBEAT_INTERVAL,
+            )
+        if item is None:
+            return None
+
+        queue = item[0].decode() if isinstance(item[0], bytes) else item[0]
+        task = next(
+            i
+            for i, (worker, _) in enumerate(self.tasks)
+            if queue in worker.lane_order()
+        )
+        self.tasks[task][0].receive(queue, item[1])
+        return task
+
+    def run_loop_once(self):
+        "Process a batch of the next task."
+
+        task = self.next_task()
+        if task is None:
+            return
+        self.waiting_since[task] = None
+        worker, predict = self.tasks[task]
+        worker.run_loop_once(predict)
+
+    def run_loop(self):
+        for worker, _ in self.tasks:
+            worker.start_heartbeat()
+        self.tasks[0][0].run_forever(self.run_loop_once)
+
+
+class WorkerPool:
+    """Run a worker loop in several forked processes and restart them when they die.
+
+    The processes are forked after the classifier is loaded, so that they share
+    its weights with the parent process (copy-on-write). The target must create
+    its own redis connection, since sockets can not be shared between processes."""
+
+    RESTART_DELAY = 1.0
+
+    def __init__(self, n_processes, target):
+        self.n_processes = n_processes
+        self.target = target
+        self.children = set()
+        self.stopping = False
+
+    def spawn(self):
+        "Fork a new worker process running the target."
+
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            status = 1
+            try:
+                self.target()
+                status = 0
+            except Exception:
+                logger.exception("worker process %d failed", os.getpid())
+            finally:
+                os._exit(status)
+
+        logger.info("started worker process %d", pid)
+        self.children.add(pid)
+
+    @staticmethod
+    def describe_exit(status):
+        "Describe the exit status of a process returned by os.wait."
+
+        if os.WIFSIGNALED(status):
+            return "was killed by signal {}".format(os.WTERMSIG(status))
+        return "exited with status {}".format(os.WEXITSTATUS(status))
+
+    def stop(self, signum=None, frame=None):
+        "Terminate all worker processes."
+
+        self.stopping = True
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        "Start the worker processes and supervise them until stopped."
+
+        handlers = {
+            signum: signal.signal(signum, self.stop)
+            for signum in (signal.SIGTERM, signal.SIGINT)
+        }
+
+        try:
+            for _ in range(self.n_processes):
+                self.spawn()
+
+            while self.children:
+                try:
+                    pid, status = os.wait()
+                except ChildProcessError:
+                    break
+                self.children.discard(pid)
+                if self.stopping:
+                    continue
+                logger.error(
+                    "worker process %d %s, restarting", pid, self.describe_exit(status)
+                )
+                time.sleep(self.RESTART_DELAY)
+                # the pool may have been stopped meanwhile
+                if not self.stopping:
+                    self.spawn()
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)